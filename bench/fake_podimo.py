@@ -0,0 +1,147 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+# A stand-in for Podimo's GraphQL API and audio CDN, for load tests and
+# benchmarks. It answers the queries that `PodimoClient` sends with generated
+# podcasts, and answers HEAD requests for the audio files of their episodes.
+#
+#   python bench/fake_podimo.py --port 18080 --episodes 300 --latency 50
+#
+# Then run the tool with GRAPHQL_URL=http://127.0.0.1:18080/graphql
+
+from aiohttp import web
+from time import time
+import argparse
+import asyncio
+import re
+
+operation_pattern = re.compile(r"query\s+(\w+)")
+
+class FakePodimo:
+    def __init__(self, args):
+        self.args = args
+        self.started = time()
+        self.base_url = f"http://{args.host}:{args.port}"
+        self.requests = dict()
+
+    # The number of episodes of a podcast grows by one every
+    # `new_episode_interval` seconds, so that refreshes find new episodes
+    def episodeCount(self):
+        count = self.args.episodes
+        if self.args.new_episode_interval > 0:
+            count += int((time() - self.started) / self.args.new_episode_interval)
+        return count
+
+    def episode(self, podcast_id, number):
+        id = f"{podcast_id}-{number:06d}"
+        day = 1 + number % 28
+        return {
+            "id": id,
+            "artist": "Bench Artist",
+            "podcastName": f"Podcast {podcast_id}",
+            "imageUrl": f"{self.base_url}/images/{podcast_id}.jpg",
+            "description": f"<p>Episode {number} of podcast {podcast_id}. " + "Lorem ipsum dolor sit amet. " * 20 + "</p>",
+            "datetime": f"2023-01-{day:02d}T12:00:00.000Z",
+            "publishDatetime": f"2023-01-{day:02d}T12:00:00.000Z",
+            "title": f"Episode {number}",
+            "audio": {"url": f"{self.base_url}/audios/{id}.mp3", "duration": 1800 + number},
+            "streamMedia": None,
+        }
+
+    def episodes(self, podcast_id, limit, offset):
+        count = self.episodeCount()
+        # Newest episodes first, like PUBLISHED_DESCENDING
+        numbers = range(count - 1 - offset, max(-1, count - 1 - offset - limit), -1)
+        return [self.episode(podcast_id, number) for number in numbers]
+
+    def podcast(self, podcast_id):
+        return {
+            "title": f"Podcast {podcast_id}",
+            "description": "A podcast that only exists for benchmarks",
+            "webAddress": None,
+            "authorName": "Bench Artist",
+            "language": "nl",
+            "images": {"coverImageUrl": f"{self.base_url}/images/{podcast_id}.jpg"},
+        }
+
+    async def graphql(self, request):
+        body = await request.json()
+        match = operation_pattern.search(body["query"])
+        operation = match.group(1) if match else "unknown"
+        variables = body.get("variables", {})
+        self.requests[operation] = self.requests.get(operation, 0) + 1
+        await asyncio.sleep(self.args.latency / 1000)
+
+        if operation == "AuthorizationPreregisterUser":
+            data = {"tokenWithPreregisterUser": {"token": "preregister-token"}}
+        elif operation == "OnboardingQuery":
+            data = {"userOnboardingFlow": {"id": "onboarding-id"}}
+        elif operation == "AuthorizationAuthorize":
+            data = {"tokenWithCredentials": {"token": f"token-{variables['email']}"}}
+        elif operation == "ChannelEpisodesQuery":
+            podcast_id = variables["podcastId"]
+            data = {
+                "episodes": self.episodes(podcast_id, variables["limit"], variables["offset"]),
+                "podcast": self.podcast(podcast_id),
+            }
+        elif operation == "BatchEpisodesQuery":
+            # The first page of multiple podcasts, with an alias for each podcast
+            data = dict()
+            i = 0
+            while f"podcast{i}" in variables:
+                podcast_id = variables[f"podcast{i}"]
+                data[f"episodes{i}"] = self.episodes(podcast_id, variables["limit"], 0)
+                data[f"podcast{i}"] = self.podcast(podcast_id)
+                i += 1
+        else:
+            return web.json_response({"errors": [{"message": f"Unknown operation {operation}"}]}, status=400)
+        return web.json_response({"data": data})
+
+    async def audio(self, request):
+        self.requests["HEAD"] = self.requests.get("HEAD", 0) + 1
+        await asyncio.sleep(self.args.head_latency / 1000)
+        return web.Response(headers={"Content-Length": str(self.args.audio_size), "Content-Type": "audio/mpeg"})
+
+    async def stats(self, request):
+        return web.json_response(self.requests)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="A stand-in for Podimo's API and audio CDN")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--episodes", type=int, default=300, help="number of episodes of every podcast")
+    parser.add_argument("--latency", type=float, default=50, help="latency of GraphQL requests, in milliseconds")
+    parser.add_argument("--head-latency", type=float, default=20, help="latency of HEAD requests, in milliseconds")
+    parser.add_argument("--audio-size", type=int, default=30_000_000, help="size of every audio file, in bytes")
+    parser.add_argument("--new-episode-interval", type=float, default=0,
+                        help="add a new episode to every podcast every this many seconds (0 = never)")
+    return parser.parse_args(argv)
+
+def create_app(args):
+    podimo = FakePodimo(args)
+    app = web.Application()
+    app.router.add_post("/graphql", podimo.graphql)
+    # HEAD requests are routed to GET handlers by aiohttp
+    app.router.add_get("/audios/{name}", podimo.audio)
+    app.router.add_get("/stats", podimo.stats)
+    return app
+
+if __name__ == "__main__":
+    args = parse_args()
+    web.run_app(create_app(args), host=args.host, port=args.port, access_log=None)
@@ -0,0 +1,253 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+# Load generator for the feeds of the tool. It starts the stand-in for Podimo
+# (see `fake_podimo.py`) and the tool itself, with an empty cache, and reports
+# the throughput, latency and memory use of the tool for these scenarios:
+# - cold: every request is for a podcast that is not in cache yet
+# - warm: all podcasts are in cache
+# - expiring: podcasts expire during the run, and are refreshed while their
+#             expired version is served
+#
+#   python bench/load.py --scenario warm --podcasts 50 --requests 2000
+#
+# Settings of the tool can be changed with --env, for example to compare
+# transports: --env GRAPHQL_TRANSPORT=aiohttp. Memory is measured on Linux only.
+
+from aiohttp import BasicAuth, ClientSession, ClientTimeout, TCPConnector
+from os.path import abspath, dirname, join
+from tempfile import mkdtemp
+from time import perf_counter
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+
+BENCH_DIR = dirname(abspath(__file__))
+ROOT_DIR = dirname(BENCH_DIR)
+SCENARIOS = ["cold", "warm", "expiring"]
+EMAIL = "bench@example.com"
+PASSWORD = "bench-password"
+
+def podcast_ids(count):
+    return [f"{i:08x}-0000-4000-8000-000000000000" for i in range(count)]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_for_port(port, process, timeout=30):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode}")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+# The resident memory of a process and its children (the workers), in bytes
+def rss(pid):
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            pids += [int(child) for child in file.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            return None
+    return total
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Bench:
+    def __init__(self, args, scenario):
+        self.args = args
+        self.scenario = scenario
+        self.podcasts = podcast_ids(args.podcasts)
+        self.fake_port = free_port()
+        self.port = free_port()
+        self.workdir = mkdtemp(prefix="podimo-bench-")
+        self.processes = []
+
+    def start(self):
+        fake = [sys.executable, join(BENCH_DIR, "fake_podimo.py"),
+                "--port", str(self.fake_port),
+                "--episodes", str(self.args.episodes),
+                "--latency", str(self.args.latency),
+                "--head-latency", str(self.args.head_latency)]
+        if self.scenario == "expiring":
+            fake += ["--new-episode-interval", str(self.args.ttl)]
+
+        env = dict(os.environ)
+        env.update({
+            "GRAPHQL_URL": f"http://127.0.0.1:{self.fake_port}/graphql",
+            "PODIMO_BIND_HOST": f"127.0.0.1:{self.port}",
+            "CACHE_DIR": join(self.workdir, "cache"),
+            "DEBUG": "false",
+        })
+        if self.args.local_credentials:
+            env.update({"LOCAL_CREDENTIALS": "true", "PODIMO_EMAIL": EMAIL, "PODIMO_PASSWORD": PASSWORD})
+        if self.scenario == "expiring":
+            env["PODCAST_CACHE_TIME"] = str(self.args.ttl)
+        for setting in self.args.env:
+            key, _, value = setting.partition("=")
+            env[key] = value
+
+        log = open(join(self.workdir, "server.log"), "w")
+        self.processes.append(subprocess.Popen(fake, stdout=log, stderr=subprocess.STDOUT))
+        self.server = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT_DIR, env=env,
+                                       stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append(self.server)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.args.keep:
+            print(f"Logs and cache are kept in {self.workdir}")
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def url(self, podcast_id):
+        url = f"http://127.0.0.1:{self.port}/feed/{podcast_id}.xml"
+        if self.args.local_credentials:
+            url += "?region=nl&locale=nl-NL"
+        return url
+
+    async def fetch(self, session, podcast_id):
+        auth = None
+        if not self.args.local_credentials:
+            auth = BasicAuth(f"{EMAIL},nl,nl-NL", PASSWORD)
+        start = perf_counter()
+        async with session.get(self.url(podcast_id), auth=auth) as response:
+            await response.read()
+            return response.status, perf_counter() - start
+
+    # Requests the podcasts in `order` with `concurrency` requests at the same time
+    async def drive(self, session, order):
+        queue = asyncio.Queue()
+        for podcast_id in order:
+            queue.put_nowait(podcast_id)
+        latencies = []
+        errors = 0
+
+        async def client():
+            nonlocal errors
+            while not queue.empty():
+                podcast_id = queue.get_nowait()
+                try:
+                    status, latency = await self.fetch(session, podcast_id)
+                    latencies.append(latency)
+                    if status != 200:
+                        errors += 1
+                except Exception:
+                    errors += 1
+
+        start = perf_counter()
+        await asyncio.gather(*[client() for _ in range(self.args.concurrency)])
+        return latencies, errors, perf_counter() - start
+
+    async def run(self):
+        self.start()
+        try:
+            await wait_for_port(self.fake_port, self.processes[0])
+            await wait_for_port(self.port, self.server)
+            timeout = ClientTimeout(total=120)
+            connector = TCPConnector(limit=self.args.concurrency)
+            async with ClientSession(timeout=timeout, connector=connector) as session:
+                if self.scenario == "cold":
+                    order = list(self.podcasts)
+                else:
+                    # Fill the caches first
+                    await self.drive(session, self.podcasts)
+                    if self.scenario == "expiring":
+                        await asyncio.sleep(self.args.ttl)
+                    order = [random.choice(self.podcasts) for _ in range(self.args.requests)]
+                latencies, errors, duration = await self.drive(session, order)
+            return {
+                "scenario": self.scenario,
+                "requests": len(order),
+                "errors": errors,
+                "throughput": len(order) / duration,
+                "p50": percentile(latencies, 0.50) * 1000,
+                "p99": percentile(latencies, 0.99) * 1000,
+                "rss": rss(self.server.pid),
+            }
+        finally:
+            self.stop()
+
+def report(results):
+    print(f"{'scenario':<10} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'RSS MiB':>8}")
+    for r in results:
+        memory = "-" if r["rss"] is None else f"{r['rss'] / 1024 / 1024:.1f}"
+        print(f"{r['scenario']:<10} {r['requests']:>8} {r['errors']:>6} {r['throughput']:>8.1f} "
+              f"{r['p50']:>8.1f} {r['p99']:>8.1f} {memory:>8}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the feeds of the tool")
+    parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="all")
+    parser.add_argument("--podcasts", type=int, default=20, help="number of different podcasts")
+    parser.add_argument("--episodes", type=int, default=300, help="number of episodes of every podcast")
+    parser.add_argument("--requests", type=int, default=1000, help="number of requests of the warm and expiring scenarios")
+    parser.add_argument("--concurrency", type=int, default=20, help="number of requests at the same time")
+    parser.add_argument("--latency", type=float, default=50, help="latency of the fake GraphQL API, in milliseconds")
+    parser.add_argument("--head-latency", type=float, default=20, help="latency of the fake audio CDN, in milliseconds")
+    parser.add_argument("--ttl", type=int, default=5, help="PODCAST_CACHE_TIME of the expiring scenario, in seconds")
+    parser.add_argument("--local-credentials", action="store_true", help="use LOCAL_CREDENTIALS instead of basic auth")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra setting for the tool, can be given multiple times")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the order of the requests")
+    parser.add_argument("--keep", action="store_true", help="keep the logs and the cache of the tool")
+    return parser.parse_args(argv)
+
+async def main(args):
+    random.seed(args.seed)
+    scenarios = SCENARIOS if args.scenario == "all" else [args.scenario]
+    results = []
+    for scenario in scenarios:
+        results.append(await Bench(args, scenario).run())
+    report(results)
+    return results
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
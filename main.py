@@ -21,25 +21,47 @@ import asyncio
 import re
 import sys
 import logging
-from os import getenv
-from podimo.client import PodimoClient
-from feedgen.feed import FeedGenerator
-from mimetypes import guess_type
-from aiohttp import ClientSession, CookieJar, ClientTimeout
-from quart import Quart, Response, render_template, request
+from os import getenv, environ
+from podimo.client import PodimoClient, EPISODES_PER_PAGE
+from quart import Quart, Response, render_template, request, g
 from hashlib import sha256
+from datetime import datetime, timezone
+from time import time, perf_counter
 from hypercorn.config import Config
 from hypercorn.asyncio import serve
-from urllib.parse import quote
+from hypercorn.run import run
+from tempfile import mkdtemp
+import shutil
+from urllib.parse import quote, urlencode
 from podimo.config import *
-from podimo.utils import generateHeaders, randomHexId
+from podimo.utils import randomHexId
+from podimo.singleflight import SingleFlight
+from podimo.scheduler import refresh_scheduler
+from podimo.scrapers import scraper_pool
+from podimo.transport import transport, QueueFullError
+from podimo.prober import head_prober
+from podimo.locks import fill_locks, leader
+from podimo.export import FeedExporter, readExportList
+from podimo.breaker import CircuitOpenError
+from podimo.ratelimit import request_priority, BACKGROUND
+from math import ceil
 import podimo.cache as cache
-import cloudscraper
+import podimo.rss as rss
+import podimo.metrics as metrics
+from podimo.timing import Timings, current_timings, measure
 import traceback
+import gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Setup Quart, used for serving the web pages
 app = Quart(__name__)
-proxies = dict()
+
+# Concurrent requests with the same credentials share a single login, also
+# when they are handled by different workers
+login_flights = SingleFlight("login", fill_locks)
 
 #Setup logging
 logging.basicConfig(
@@ -62,12 +84,27 @@ Note that the username and password should be URL encoded. This can be done with
 a tool like https://gchq.github.io/CyberChef/#recipe=URL_Encode(true)
 """
 
+@app.before_request
+def start_timer():
+    g.start = perf_counter()
+
 @app.after_request
 def allow_cors(response):
     response.headers.set('Access-Control-Allow-Origin', '*')
     response.headers.set('Access-Control-Allow-Methods', 'GET, POST')
     response.headers.set('Cache-Control', 'max-age=900')
     logging.debug(f"Incoming {request.method} request for '{request.url}' from User-Agent {request.user_agent} at {request.remote_addr}.")
+
+    route = request.url_rule.rule if request.url_rule else "unknown"
+    metrics.http_requests.inc(route=route, method=request.method, status=response.status_code)
+    if "start" in g:
+        metrics.http_duration.observe(perf_counter() - g.start, route=route)
+
+    timings = g.get("timings")
+    if timings is not None:
+        response.headers.set('Server-Timing', timings.header())
+        if TIMING_LOG:
+            timings.log(status=response.status_code)
     return response
 
 def authenticate():
@@ -83,6 +120,13 @@ You need to login with the correct credentials for Podimo.
         },
     )
 
+def unavailable(retry_after):
+    return Response(
+        "Podimo is unavailable at the moment. Please try again later.",
+        503,
+        {"Content-Type": "text/plain", "Retry-After": str(ceil(retry_after))},
+    )
+
 def initialize_client(username: str, password: str, region: str, locale: str) -> PodimoClient:
     client = PodimoClient(username, password, region, locale)
 
@@ -92,21 +136,35 @@ def initialize_client(username: str, password: str, region: str, locale: str) ->
     client.token = cache.getCacheEntry(key, cache.TOKENS)
 
     # Check if we previously created a cookie jar
-    if key not in cache.cookie_jars:
-        cache.cookie_jars[key] = CookieJar()
-    client.cookie_jar = cache.cookie_jars[key]
+    client.cookie_jar = cache.getCookieJar(key)
     return client
 
-async def check_auth(username, password, region, locale, scraper):
+async def login(client):
+    # Another worker may have logged in while this one was waiting for its turn
+    cache.TOKENS.forget(client.key)
+    token = cache.getCacheEntry(client.key, cache.TOKENS)
+    if token:
+        return token
+
+    # The login is shared with other requests, so it takes its own scraper
+    # instead of the one of the request that started it
+    async with scraper_pool.acquire() as scraper:
+        await client.podimoLogin(scraper)
+    cache.insertIntoTokenCache(client.key, client.token)
+    cache.storeCookieJar(client.key, client.cookie_jar)
+    return client.token
+
+async def check_auth(username, password, region, locale):
     try:
         client = initialize_client(username, password, region, locale)
         if client.token:
             return client
 
-        await client.podimoLogin(scraper)
-        cache.insertIntoTokenCache(client.key, client.token)
+        client.token = await login_flights.do(client.key, lambda: login(client))
         return client
 
+    except (CircuitOpenError, QueueFullError):
+        raise
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         if DEBUG:
@@ -164,6 +222,13 @@ async def index():
     return await render_template("index.html", error=error, locales=LOCALES, regions=REGIONS, need_credentials=not(LOCAL_CREDENTIALS))
 
 
+@app.route("/metrics")
+async def serve_metrics():
+    if not METRICS:
+        return await not_found(None)
+    return Response(metrics.registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4"})
+
+
 @app.errorhandler(404)
 async def not_found(error):
     return Response(
@@ -187,6 +252,96 @@ async def serve_basic_auth_feed(podcast_id):
             return await serve_feed(username, auth.password, podcast_id, region, locale)
 
 
+# The maximum number of podcasts that are pre-warmed at once
+MAX_PREWARM_PODCASTS = 200
+
+# Podcast ids in feed URLs of this tool, like in the OPML export of a podcast
+# app, and in links to podcasts on Podimo's website
+podcast_url_pattern = re.compile(r"/feed(?:/[^/\s]+/[^/\s]+)?/([0-9a-fA-F\-]+)\.xml|/shows/([0-9a-fA-F\-]+)")
+
+# Podcast ids consist of hexadecimal digits and dashes, and at least one digit
+def is_podcast_id(word):
+    return podcast_id_pattern.fullmatch(word) is not None and re.search(r"[0-9a-fA-F]", word) is not None
+
+def extract_podcast_ids(text):
+    ids = []
+    if text.lstrip().startswith("<"):
+        # In an OPML file, only the links to podcasts contain podcast ids
+        ids = [feed or show for feed, show in podcast_url_pattern.findall(text)]
+    else:
+        for line in text.splitlines():
+            urls = podcast_url_pattern.findall(line)
+            if urls:
+                ids += [feed or show for feed, show in urls]
+                continue
+            # A plain list of podcast ids. Lines with anything else are ignored.
+            words = [word for word in re.split(r"[\s,]+", line) if word]
+            if all(is_podcast_id(word) for word in words):
+                ids += words
+    ids = [id for id in ids if is_podcast_id(id)]
+    # Remove duplicates, but keep the order
+    return list(dict.fromkeys(ids))[:MAX_PREWARM_PODCASTS]
+
+# Fills the caches with the given podcasts and the sizes of their episodes.
+# Returns a summary of what was pre-warmed.
+async def prewarm(client, podcast_ids, locale):
+    podcast_ids = [id for id in podcast_ids if id not in BLOCKED]
+    # Pre-warming waits for requests for feeds
+    token = request_priority.set(BACKGROUND)
+    try:
+        podcasts = await client.prewarmPodcasts(podcast_ids)
+
+        probes = []
+        for data in podcasts.values():
+            for episode in data["episodes"]:
+                url, _ = extract_audio_url(episode)
+                if url is not None:
+                    probes.append(head_prober.probe(episode["id"], url, locale))
+        results = await asyncio.gather(*probes, return_exceptions=True)
+    finally:
+        request_priority.reset(token)
+
+    return {
+        "podcasts": list(podcasts),
+        "failed_podcasts": [id for id in podcast_ids if id not in podcasts],
+        "episodes": len(probes),
+        "failed_episodes": sum(1 for result in results if isinstance(result, Exception)),
+    }
+
+# Pre-warms the podcasts in the body of the request. The body can be an OPML
+# file, or a list of podcast ids or feed URLs.
+@app.route("/prewarm", methods=["POST"])
+async def serve_prewarm():
+    # With local credentials, anyone could make this tool fetch podcasts with
+    # the account of the owner. Use `python prewarm.py` instead.
+    if LOCAL_CREDENTIALS:
+        return await not_found(None)
+
+    auth = request.authorization
+    if not auth:
+        return authenticate()
+    username, region, locale = split_username_region_locale(auth.username)
+    password = auth.password
+
+    if region not in [region_code for (region_code, _) in REGIONS]:
+        return Response("Invalid region", 400, {})
+    if locale not in LOCALES:
+        return Response("Invalid locale", 400, {})
+
+    podcast_ids = extract_podcast_ids(await request.get_data(as_text=True))
+    if not podcast_ids:
+        return Response("No podcast ids found", 400, {})
+
+    try:
+        client = await check_auth(username, password, region, locale)
+    except (CircuitOpenError, QueueFullError) as e:
+        return unavailable(e.retry_after)
+    if not client:
+        return authenticate()
+
+    return await prewarm(client, podcast_ids, locale)
+
+
 def split_username_region_locale(string):
     s = string.split(',')
     if len(s) == 3:
@@ -204,6 +359,9 @@ def token_key(username, password):
 
 @app.route("/feed/<string:username>/<string:password>/<string:podcast_id>.xml")
 async def serve_feed(username, password, podcast_id, region, locale):
+    timings = Timings(podcast=podcast_id)
+    current_timings.set(timings)
+    g.timings = timings
     
     logging.debug(f"Feed request for podcast {podcast_id} from IP {request.remote_addr} with User-Agent:{request.user_agent}.")
     
@@ -220,62 +378,233 @@ async def serve_feed(username, password, podcast_id, region, locale):
     if any(item in request.url for item in BLOCKED):
         logging.debug(f"Blocked! Podcast {podcast_id} is on local block list")
         return Response("Podcast is gone", 410, {}) 
-    
-    with cloudscraper.create_scraper() as scraper:
-        scraper.proxies = proxies
-        client = await check_auth(username, password, region, locale, scraper)
-        if not client:
-            return authenticate()
 
-        # Get a list of valid podcasts
-        try:
-            podcasts = await podcastsToRss(
-                podcast_id, await client.getPodcasts(podcast_id, scraper), locale
-            )
-        except Exception as e:
-            exception = str(e)
-            if "Podcast not found" in exception:
-                return Response(
-                    "Podcast not found. Are you sure you have the correct ID?", 404, {}
-                )
-            logging.error(f"Error while fetching podcasts: {exception}")
-            return Response("Something went wrong while fetching the podcasts", 500, {})
-        return Response(podcasts, mimetype="text/xml")
-
-
-async def urlHeadInfo(session, id, url, locale):
-    entry = cache.getHeadEntry(id)
-    if entry:
-        return entry
-
-    retries = 3  # Number of retries
-    timeout = ClientTimeout(total=10)  # 10 seconds timeout for each try
-
-    for attempt in range(retries):
-        try:
-            logging.debug(f"HEAD request to {url} (Attempt {attempt + 1})")
-            async with session.head(url, allow_redirects=True,
-                                    headers=generateHeaders(None, locale),
-                                    timeout=timeout) as response:
-                content_length = 0
-                content_type, _ = guess_type(url)
-                if 'content-length' in response.headers:
-                    content_length = response.headers['content-length']
-                if content_type is None and 'content-type' in response.headers:
-                    content_type = response.headers['content-type']
-                else:
-                    content_type = 'audio/mpeg'
-                cache.insertIntoHeadCache(id, content_length, content_type)
-                return (content_length, content_type)
-
-        except asyncio.TimeoutError:
-            if attempt < retries - 1:
-                logging.info(f"Retrying HEAD request to {url} (Attempt {attempt + 2})")
-                await asyncio.sleep(1)  # Wait for 1 second before retrying
+    try:
+        window = parse_window(request.args)
+    except ValueError as e:
+        return Response(str(e), 400, {})
+    
+    try:
+        with measure("auth"):
+            client = await check_auth(username, password, region, locale)
+    except (CircuitOpenError, QueueFullError) as e:
+        return unavailable(e.retry_after)
+    if not client:
+        return authenticate()
+    # Windowed feeds do not need all episodes, so they are not refreshed in
+    # the background
+    if window is None:
+        refresh_scheduler.track(podcast_id, client)
+
+    # Serve the feed that was rendered before, if the podcast did not change since
+    key = feed_key(podcast_id, locale, window)
+    with measure("cache"):
+        feed = cache.getFeedEntry(key)
+    if feed:
+        logging.debug(f"Got rendered feed for podcast {podcast_id} from cache")
+        return feed_response(feed)
+
+    # Get a list of valid podcasts
+    try:
+        links = ()
+        with measure("podcast"):
+            if window is None:
+                data = await client.getPodcasts(podcast_id)
             else:
-                logging.error(f"All retries failed for HEAD request to {url}")
-                raise  # Re-raise the last exception if all retries fail
+                limit, page = window
+                data, more = await client.getEpisodeWindow(podcast_id, limit, (page - 1) * limit)
+        if window is not None:
+            if page > 1 and len(data["episodes"]) == 0:
+                return Response("Page not found", 404, {})
+            links = page_links(podcast_id, window, more)
+        parts, complete = await podcastsToRss(podcast_id, data, locale, links)
+    except Exception as e:
+        exception = str(e)
+        if "Podcast not found" in exception:
+            return Response(
+                "Podcast not found. Are you sure you have the correct ID?", 404, {}
+            )
+        logging.error(f"Error while fetching podcasts: {exception}")
+
+        # Serve the last feed of the podcast that was rendered, marked as stale
+        feed = cache.getFallbackEntry(key)
+        if feed:
+            logging.info(f"Serving the last known feed of podcast {podcast_id}")
+            metrics.fallback_feeds.inc()
+            response = feed_response(feed)
+            response.headers.set('Warning', '110 - "Response is Stale"')
+            return response
+        if isinstance(e, (CircuitOpenError, QueueFullError)):
+            return unavailable(e.retry_after)
+        return Response("Something went wrong while fetching the podcasts", 500, {})
+
+    # Feeds that are rendered from an expired podcast are not cached, since
+    # the background refresh will replace the podcast soon. The same goes for
+    # feeds with episodes whose size is still being looked up. Those feeds are
+    # rendered again when the sizes are known.
+    cacheable = complete and not client.stale
+    if not complete and not client.stale:
+        render_when_probed(key, podcast_id, data, locale, links)
+
+    with measure("build"):
+        body = b"".join(parts)
+    with measure("serialize"):
+        feed = store_feed(key, podcast_id, body, cacheable, data["expires"])
+    return feed_response(feed)
+
+
+# The keys of the feeds that wait for their HEAD requests to be rendered again
+rendering = set()
+render_tasks = set()
+
+def render_when_probed(key, podcast_id, data, locale, links):
+    if key in rendering:
+        return
+    rendering.add(key)
+    task = asyncio.ensure_future(render_probed_feed(key, podcast_id, data, locale, links))
+    render_tasks.add(task)
+    task.add_done_callback(render_tasks.discard)
+
+# Renders a feed again and caches it, after the HEAD requests for the
+# episodes whose size was unknown finished in the background
+async def render_probed_feed(key, podcast_id, data, locale, links):
+    # Rendering the feed again is not part of the request that started it
+    current_timings.set(None)
+    try:
+        probes = []
+        for episode in data["episodes"]:
+            url, _ = extract_audio_url(episode)
+            if url is not None and cache.getHeadEntry(episode["id"]) is None:
+                probes.append(head_prober.enqueue(episode["id"], url, locale))
+        await asyncio.gather(*probes)
+
+        parts, complete = await podcastsToRss(podcast_id, data, locale, links)
+        if complete:
+            store_feed(key, podcast_id, b"".join(parts), True, data["expires"])
+            logging.debug(f"Rendered feed for podcast {podcast_id} again, after the size of its episodes was found")
+    except Exception as e:
+        logging.error(f"Could not render feed for podcast {podcast_id} again: {e}")
+    finally:
+        rendering.discard(key)
+
+
+# `expires` is the time at which the cached podcast that the feed was rendered
+# from expires, or None for windowed feeds of podcasts that are not in cache
+def store_feed(key, podcast_id, podcasts, cacheable, expires):
+    etag = sha256(podcasts).hexdigest()
+    # A feed that is rendered again without changes keeps the time at which it
+    # was last modified, so clients can keep revalidating it
+    last_modified = int(time())
+    previous = cache.getFallbackEntry(key)
+    if previous is not None and previous["etag"] == etag:
+        last_modified = previous["last_modified"]
+    feed = {
+        "body": podcasts,
+        "etag": etag,
+        "last_modified": last_modified,
+        # The feed is compressed once, instead of for every request
+        "encodings": compress_feed(podcasts),
+    }
+    cache.insertIntoFallbackCache(key, feed)
+    # The rendered feed is valid for as long as the podcast it was rendered
+    # from is cached. When the podcast was cached again while the feed was
+    # rendered, the feed is outdated already.
+    if cacheable and cache.getPodcastExpiry(podcast_id) == expires:
+        timeout = PODCAST_CACHE_TIME if expires is None else expires - time()
+        if timeout > 0:
+            cache.insertIntoFeedCache(key, podcast_id, feed, timeout)
+    return feed
+
 
+def feed_key(podcast_id, locale, window=None):
+    key = f"{podcast_id}~{locale}~{PUBLIC_FEEDS}"
+    if window is not None:
+        limit, page = window
+        key += f"~{limit}~{page}"
+    return key
+
+
+# Windowed feeds are fetched with a single request to Podimo
+MAX_FEED_LIMIT = EPISODES_PER_PAGE
+
+# Feeds can contain only the newest `limit` episodes, and can be split into
+# pages of `limit` episodes with `page`. Returns None for feeds with all episodes.
+def parse_window(args):
+    limit = args.get("limit")
+    page = args.get("page")
+    if limit is None and page is None:
+        return None
+    try:
+        limit = int(limit) if limit is not None else MAX_FEED_LIMIT
+        page = int(page) if page is not None else 1
+    except ValueError:
+        raise ValueError("Invalid limit or page")
+    if limit < 1 or limit > MAX_FEED_LIMIT:
+        raise ValueError(f"Limit should be between 1 and {MAX_FEED_LIMIT}")
+    if page < 1:
+        raise ValueError("Invalid page")
+    return limit, page
+
+
+# The links between the pages of a paged feed (RFC 5005, section 3). The links
+# are relative, so a feed never contains the credentials of another user.
+def page_links(podcast_id, window, more):
+    limit, page = window
+    args = {name: value for name, value in request.args.items() if name not in ["limit", "page"]}
+    def link(page):
+        return f"{podcast_id}.xml?{urlencode({**args, 'limit': limit, 'page': page})}"
+
+    links = [("first", link(1))]
+    if page > 1:
+        links.append(("previous", link(page - 1)))
+    if more:
+        links.append(("next", link(page + 1)))
+    return links
+
+
+# Returns the compressed variants of a feed, by content coding. Brotli is
+# only used when the brotli package is installed.
+def compress_feed(body):
+    encodings = {"gzip": gzip.compress(body, compresslevel=6, mtime=0)}
+    if brotli is not None:
+        encodings["br"] = brotli.compress(body, quality=5)
+    return encodings
+
+
+# Picks the variant of the feed that the client prefers, and returns it
+# together with its content coding and ETag
+def negotiate_encoding(feed):
+    # Feeds that were cached before they were compressed have no variants
+    encodings = feed.get("encodings", {})
+    encoding = request.accept_encodings.best_match(
+        [encoding for encoding in ["br", "gzip"] if encoding in encodings], default="identity")
+    if encoding == "identity":
+        return feed["body"], None, feed["etag"]
+    # Every variant has its own ETag (RFC 9110, 8.8.3)
+    return encodings[encoding], encoding, f"{feed['etag']}-{encoding}"
+
+
+def is_not_modified(feed, etag):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110, 13.2.2)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return request.if_modified_since.timestamp() >= feed["last_modified"]
+    return False
+
+
+def feed_response(feed):
+    body, encoding, etag = negotiate_encoding(feed)
+    if is_not_modified(feed, etag):
+        response = Response("", 304)
+    else:
+        response = Response(body, mimetype="text/xml")
+        if encoding is not None:
+            response.content_encoding = encoding
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    response.last_modified = datetime.fromtimestamp(feed["last_modified"], timezone.utc)
+    return response
 
 
 def extract_audio_url(episode):
@@ -296,91 +625,210 @@ def extract_audio_url(episode):
     return url, duration
 
 
-async def addFeedEntry(fg, episode, session, locale):
-    fe = fg.add_entry()
-    fe.guid(episode["id"])
-    fe.title(episode["title"])
-    fe.description(episode["description"])
-    fe.pubDate(episode.get("publishDatetime", episode.get("datetime")))
-    fe.podcast.itunes_image(episode["imageUrl"])
-
-    url, duration = extract_audio_url(episode)
-    if url is None:
-        return 
-    logging.debug(f"Found podcast '{episode['title']}'")
-    fe.podcast.itunes_duration(duration)
-    content_length, content_type = await urlHeadInfo(session, episode['id'], url, locale)
-    fe.enclosure(url, content_length, content_type)
+def addFeedEntry(episode, url, duration, head):
+    length, type = None, None
+    if url is not None:
+        logging.debug(f"Found podcast '{episode['title']}'")
+        length, type = head
+    fields = (
+        episode["id"],
+        episode["title"],
+        episode["description"],
+        episode.get("publishDatetime", episode.get("datetime")),
+        episode["imageUrl"],
+        url,
+        duration,
+        length,
+        type,
+    )
+    digest = sha256(repr(fields).encode("utf-8")).hexdigest()
+    item = cache.getItemEntry(episode["id"], digest)
+    if item is None:
+        item = rss.renderItem(*fields).encode("utf-8")
+        cache.insertIntoItemCache(episode["id"], digest, item)
+    return item
 
-def chunks(x, n):
-    for i in range(0, len(x), n):
-        yield x[i:i + n]
+# The size and type of episodes whose HEAD request is still running in the background
+UNKNOWN_HEAD = (0, 'audio/mpeg')
 
-async def podcastsToRss(podcast_id, data, locale):
-    fg = FeedGenerator()
-    fg.load_extension("podcast")
+async def headInfo(episode, url, locale):
+    if url is None:
+        return None
+    if BACKGROUND_HEAD_REQUESTS:
+        head = cache.getHeadEntry(episode['id'])
+        if head is None:
+            head_prober.enqueue(episode['id'], url, locale)
+        return head
+    try:
+        return await head_prober.probe(episode['id'], url, locale)
+    except Exception as e:
+        # The failure is cached, so the episode is in the feed with a size of 0
+        logging.error(f"HEAD request for episode {episode['id']} failed: {e}")
+        return cache.getHeadEntry(episode['id'])
 
+# Returns a generator with the parts of the feed, and whether the size of
+# every episode was known while rendering the feed
+async def podcastsToRss(podcast_id, data, locale, links=()):
     podcast = data["podcast"]
     episodes = data["episodes"]
 
-    if len(episodes) > 0:
-        last_episode = episodes[0]
-        title = podcast["title"]
-        if podcast["title"] is None:
-            title = last_episode["podcastName"]
-        fg.title(title)
-
-        if podcast["description"]:
-            fg.description(podcast["description"])
-        else:
-            fg.description(title)
+    if len(episodes) == 0:
+        raise ValueError("Required fields not set (title, link, description)")
 
-        fg.link(href=f"https://podimo.com/shows/{podcast_id}", rel="alternate")
+    last_episode = episodes[0]
+    title = podcast["title"]
+    if podcast["title"] is None:
+        title = last_episode["podcastName"]
 
-        image = podcast["images"]["coverImageUrl"]
-        if image is None:
-            image = last_episode['imageUrl']
-        fg.image(image)
-
-        language = podcast["language"]
-        if language is None:
-            language = locale
-        fg.language(language)
-
-        artist = podcast["authorName"]
-        if artist is None:
-            artist = last_episode["artist"]
-        fg.podcast.itunes_author(artist)
-
-        if not PUBLIC_FEEDS:
-            fg.podcast.itunes_block(True)
-
-    async with ClientSession() as session:
-        for chunk in chunks(episodes, 5):
-            await asyncio.gather(
-                *[addFeedEntry(fg, episode, session, locale) for episode in chunk]
-            )
-
-    feed = fg.rss_str(pretty=True)
-    return feed
-
-
-async def spawn_web_server():
+    if podcast["description"]:
+        description = podcast["description"]
+    else:
+        description = title
+
+    link = f"https://podimo.com/shows/{podcast_id}"
+
+    image = podcast["images"]["coverImageUrl"]
+    if image is None:
+        image = last_episode['imageUrl']
+
+    language = podcast["language"]
+    if language is None:
+        language = locale
+
+    artist = podcast["authorName"]
+    if artist is None:
+        artist = last_episode["artist"]
+
+    block = None
+    if not PUBLIC_FEEDS:
+        block = True
+
+    # The feed was last changed when the newest episode was published, so that
+    # the feed is the same every time it is rendered until something changes
+    last_build_date = None
+    for episode in episodes:
+        date = episode.get("publishDatetime", episode.get("datetime"))
+        if date:
+            last_build_date = rss.parseDate(date)
+            if last_build_date is not None:
+                break
+
+    channel = rss.renderChannel(title, link, description, image, language, artist, block, last_build_date, links)
+
+    audio = [extract_audio_url(episode) for episode in episodes]
+    with measure("head"):
+        heads = await asyncio.gather(
+            *[headInfo(episode, url, locale) for episode, (url, _) in zip(episodes, audio)]
+        )
+    complete = True
+    for i, (url, _) in enumerate(audio):
+        if url is not None and heads[i] is None:
+            heads[i] = UNKNOWN_HEAD
+            complete = False
+    return feedParts(channel, episodes, audio, heads), complete
+
+def feedParts(channel, episodes, audio, heads):
+    yield channel.encode("utf-8")
+    # The oldest episode comes first, like it did when the feeds were generated with feedgen
+    for i in reversed(range(len(episodes))):
+        url, duration = audio[i]
+        yield addFeedEntry(episodes[i], url, duration, heads[i])
+    yield rss.RSS_END.encode("utf-8")
+
+
+# Writes the feeds in EXPORT_FEEDS_FILE to EXPORT_DIR every EXPORT_INTERVAL
+# seconds. A feed is only rendered and written again when its episodes changed.
+async def export_feeds():
+    if not PODIMO_EMAIL or not PODIMO_PASSWORD:
+        logging.error("Exporting feeds needs PODIMO_EMAIL and PODIMO_PASSWORD, no feeds are exported")
+        return
+    exporter = FeedExporter(EXPORT_DIR)
+    # Exporting feeds waits for requests for feeds
+    request_priority.set(BACKGROUND)
+    while True:
+        # Only one of the workers exports the feeds
+        if leader is None or leader.isLeader():
+            for podcast_id, region, locale in readExportList(EXPORT_FEEDS_FILE):
+                if podcast_id in BLOCKED:
+                    continue
+                try:
+                    await export_feed(exporter, podcast_id, region, locale)
+                except Exception as e:
+                    logging.error(f"Could not export podcast {podcast_id}: {e}")
+        await asyncio.sleep(EXPORT_INTERVAL)
+
+async def export_feed(exporter, podcast_id, region, locale):
+    client = await check_auth(PODIMO_EMAIL, PODIMO_PASSWORD, region, locale)
+    if not client:
+        raise ValueError("Invalid credentials")
+    data = await client.getPodcasts(podcast_id)
+    # The exported podcasts are kept up to date like the ones that are requested
+    refresh_scheduler.track(podcast_id, client)
+
+    fingerprint = exporter.fingerprint(data)
+    if exporter.isCurrent(podcast_id, fingerprint):
+        return
+    parts, complete = await podcastsToRss(podcast_id, data, locale)
+    exporter.write(podcast_id, b"".join(parts), fingerprint, complete)
+    logging.info(f"Exported podcast {podcast_id} to {exporter.path(podcast_id)}")
+
+
+# Every worker runs its own background tasks
+background_tasks = []
+
+@app.before_serving
+async def start_background_tasks():
+    tasks = [refresh_scheduler.run(), cache.sweepCaches()]
+    if EXPORT_DIR:
+        tasks.append(export_feeds())
+    for task in tasks:
+        background_tasks.append(asyncio.ensure_future(task))
+
+@app.after_serving
+async def close_connections():
+    for task in background_tasks + list(render_tasks):
+        task.cancel()
+    await transport.close()
+    await head_prober.close()
+
+def server_config():
     config = Config()
     config.bind = [PODIMO_BIND_HOST]
     config.read_timeout = 60
     config.graceful_timeout = 5
     config.backlog = 1000
     app.config['TEMPLATES_AUTO_RELOAD'] = True
-    await serve(app, config)
+    return config
+
+async def spawn_web_server():
+    await serve(app, server_config())
+
+# Starts WORKERS processes that each import this module and serve the app
+def spawn_workers():
+    config = server_config()
+    config.application_path = "main:app"
+    config.workers = WORKERS
+
+    # Login tokens and cookies are shared through a temporary directory
+    # when they should not be stored on disk
+    runtime_dir = None
+    if not STORE_TOKENS_ON_DISK:
+        runtime_dir = mkdtemp(prefix="podimo-")
+        environ["PODIMO_RUNTIME_DIR"] = runtime_dir
+        logging.warning(f"STORE_TOKENS_ON_DISK is false, but login tokens and cookies are written "
+                        f"to {runtime_dir} to share them between the {WORKERS} workers. "
+                        f"Set WORKERS=1 to keep them in memory only.")
+    if METRICS:
+        logging.warning(f"Every one of the {WORKERS} workers has its own metrics, so /metrics only "
+                        f"shows the metrics of the worker that answers the request.")
+    try:
+        run(config)
+    finally:
+        if runtime_dir is not None:
+            shutil.rmtree(runtime_dir, ignore_errors=True)
 
 async def main():
-    if HTTP_PROXY:
-        global proxies
-        logging.info(f"Running with https proxy defined in environmental variable HTTP_PROXY: {HTTP_PROXY}")
-        proxies['https'] = HTTP_PROXY
-    tasks = [spawn_web_server()]
-    await asyncio.gather(*tasks)
+    await spawn_web_server()
 
 if __name__ == "__main__":
     if DEBUG:
@@ -395,11 +843,52 @@ Configuration:
 - HTTP_PROXY: {HTTP_PROXY}
 - ZENROWS_API: {ZENROWS_API}
 - SCRAPER_API: {SCRAPER_API}
+- GRAPHQL_TRANSPORT: {GRAPHQL_TRANSPORT}
+- GRAPHQL_CONCURRENCY: {GRAPHQL_CONCURRENCY}
+- GRAPHQL_MAX_QUEUE: {GRAPHQL_MAX_QUEUE}
+- GRAPHQL_RATE_LIMIT: {GRAPHQL_RATE_LIMIT} per sec
+- GRAPHQL_BURST: {GRAPHQL_BURST}
+- BREAKER_THRESHOLD: {BREAKER_THRESHOLD}
+- BREAKER_BACKOFF: {BREAKER_BACKOFF} sec
+- BREAKER_MAX_BACKOFF: {BREAKER_MAX_BACKOFF} sec
+- GRAPHQL_PAGE_CONCURRENCY: {GRAPHQL_PAGE_CONCURRENCY}
+- PREWARM_BATCH_SIZE: {PREWARM_BATCH_SIZE}
+- EXPORT_DIR: {EXPORT_DIR}
+- EXPORT_FEEDS_FILE: {EXPORT_FEEDS_FILE}
+- EXPORT_INTERVAL: {EXPORT_INTERVAL} sec
+- SCRAPER_POOL_SIZE: {SCRAPER_POOL_SIZE}
+- SCRAPER_MAX_AGE: {SCRAPER_MAX_AGE} sec
+- HEAD_CONCURRENCY: {HEAD_CONCURRENCY}
+- HEAD_CONCURRENCY_PER_HOST: {HEAD_CONCURRENCY_PER_HOST}
+- WORKERS: {WORKERS}
+- WORKER_MEMORY_CACHE_TIME: {WORKER_MEMORY_CACHE_TIME} sec
+- METRICS: {METRICS}
+- TIMING_LOG: {TIMING_LOG}
+- BACKGROUND_HEAD_REQUESTS: {BACKGROUND_HEAD_REQUESTS}
 - CACHE_DIR: {CACHE_DIR}
+- MEMORY_CACHE_ENTRIES: {MEMORY_CACHE_ENTRIES}
+- MEMORY_CACHE_SIZE: {MEMORY_CACHE_SIZE} bytes
+- PODCAST_CACHE_SIZE_LIMIT: {PODCAST_CACHE_SIZE_LIMIT} bytes
+- HEAD_CACHE_SIZE_LIMIT: {HEAD_CACHE_SIZE_LIMIT} bytes
+- FEED_CACHE_SIZE_LIMIT: {FEED_CACHE_SIZE_LIMIT} bytes
+- ITEM_CACHE_SIZE_LIMIT: {ITEM_CACHE_SIZE_LIMIT} bytes
+- FALLBACK_CACHE_SIZE_LIMIT: {FALLBACK_CACHE_SIZE_LIMIT} bytes
+- CACHE_SWEEP_INTERVAL: {CACHE_SWEEP_INTERVAL} sec
 - STORE_TOKENS_ON_DISK: {STORE_TOKENS_ON_DISK}
 - TOKEN_CACHE_TIME: {TOKEN_CACHE_TIME} sec
 - PODCAST_CACHE_TIME: {PODCAST_CACHE_TIME} sec
+- PODCAST_FULL_SYNC_TIME: {PODCAST_FULL_SYNC_TIME} sec
+- PODCAST_STALE_TIME: {PODCAST_STALE_TIME} sec
+- REFRESH_MIN_REQUESTS: {REFRESH_MIN_REQUESTS}
+- REFRESH_AHEAD_TIME: {REFRESH_AHEAD_TIME} sec
+- FALLBACK_CACHE_TIME: {FALLBACK_CACHE_TIME} sec
 - HEAD_CACHE_TIME: {HEAD_CACHE_TIME} sec
+- HEAD_FAILURE_CACHE_TIME: {HEAD_FAILURE_CACHE_TIME} sec
 - BLOCKING: {BLOCKED}
 """)
-    asyncio.run(main())
+    if HTTP_PROXY:
+        logging.info(f"Running with https proxy defined in environmental variable HTTP_PROXY: {HTTP_PROXY}")
+    if WORKERS > 1:
+        spawn_workers()
+    else:
+        asyncio.run(main())
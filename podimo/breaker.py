@@ -0,0 +1,101 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from podimo.config import BREAKER_THRESHOLD, BREAKER_BACKOFF, BREAKER_MAX_BACKOFF
+from podimo.metrics import registry, Gauge
+from time import monotonic
+import logging
+import random
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, retry_after: float):
+        super().__init__("Podimo is unavailable, not sending any requests for now")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """
+    Stops sending requests to Podimo after `threshold` requests in a row
+    failed, so that requests fail right away instead of piling up while
+    Podimo (or Cloudflare) is down. After a random part of the backoff time,
+    one request is let through to try again. If it fails, the backoff time is
+    doubled, up to `max_backoff` seconds.
+    """
+    def __init__(self, threshold: int, backoff: float, max_backoff: float):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        # The number of times in a row that the circuit opened
+        self.openings = 0
+        # Until when no requests are sent, if the circuit is open
+        self.open_until = None
+        # Whether a request was let through to try again
+        self.trial = False
+
+    def isOpen(self):
+        return self.open_until is not None
+
+    def retryAfter(self):
+        if self.open_until is None:
+            return 0
+        return max(0, self.open_until - monotonic())
+
+    # Raises a `CircuitOpenError` if no request should be sent right now
+    def check(self):
+        if self.open_until is None:
+            return
+        now = monotonic()
+        if now < self.open_until:
+            raise CircuitOpenError(self.open_until - now)
+        # Let this request through to try again, but hold back the others
+        # until it finished, or until it took too long
+        logging.info("Trying to reach Podimo again")
+        self.trial = True
+        self.open_until = now + self.backoffTime()
+
+    def success(self):
+        if self.open_until is not None:
+            logging.info("Podimo is reachable again")
+        self.failures = 0
+        self.openings = 0
+        self.open_until = None
+        self.trial = False
+
+    def failure(self):
+        # Requests that were sent before the circuit opened don't count
+        if self.open_until is not None and not self.trial:
+            return
+        self.trial = False
+        self.failures += 1
+        if self.failures >= self.threshold or self.open_until is not None:
+            self.openings += 1
+            backoff = self.backoffTime()
+            self.open_until = monotonic() + backoff
+            logging.error(f"Podimo is unavailable, not sending any requests for {backoff:.0f} seconds")
+
+    # Exponential backoff with jitter
+    def backoffTime(self):
+        backoff = min(self.max_backoff, self.backoff * 2 ** max(0, self.openings - 1))
+        return random.uniform(backoff / 2, backoff)
+
+circuit_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_BACKOFF, BREAKER_MAX_BACKOFF)
+
+registry.add(Gauge(
+    "podimo_circuit_breaker_open", "Whether requests to Podimo are held back because it is unavailable",
+    collect=lambda: {(): int(circuit_breaker.isOpen())}))
@@ -20,52 +20,253 @@
 from podimo.config import *
 from typing import Dict, Tuple
 from time import time
-from diskcache import Cache
+from podimo.lru import TieredCache
+from podimo.codec import encodePodcast, decodePodcast
+from podimo.locks import leader
+from aiohttp import CookieJar
+from diskcache import Cache as DiskCache
 from os.path import join
+from os import getenv
+import asyncio
+import logging
+
+# All caches keep their most recently used entries in memory, in front of
+# the cache on disk. Caches are not culled while an entry is stored; the
+# cache sweeper (see `sweepCaches`) removes expired entries and keeps the
+# caches within their size limit instead.
+# When there are multiple workers, they share the caches on disk, and entries
+# are only kept in memory for a short time.
+def Cache(directory, **settings):
+    disk = DiskCache(directory, cull_limit=0, **settings)
+    max_age = WORKER_MEMORY_CACHE_TIME if WORKERS > 1 else None
+    return TieredCache(disk, MEMORY_CACHE_ENTRIES, MEMORY_CACHE_SIZE, max_age)
+
+# Workers that should not store login tokens on disk share them through a
+# temporary directory instead, which is created by the main process before
+# the workers are started (see `main.py`). It is removed when the main
+# process stops.
+RUNTIME_DIR = getenv("PODIMO_RUNTIME_DIR")
 
 # Store the authentication token in a dictionary
 # so it is not necessary to request a new token for every request. The key is
 # derived from the provided username and password (see the `token_key` function).
-TOKENS = dict()
+TOKENS = TieredCache(None, MEMORY_CACHE_ENTRIES, MEMORY_CACHE_SIZE)
 if STORE_TOKENS_ON_DISK:
-    TOKENS = Cache(join(CACHE_DIR, 'tokens_cache'))
+    TOKENS = Cache(join(CACHE_DIR, 'tokens_cache'), size_limit=TOKEN_CACHE_SIZE_LIMIT,
+                   eviction_policy='least-recently-stored')
+elif RUNTIME_DIR:
+    TOKENS = Cache(join(RUNTIME_DIR, 'tokens_cache'), size_limit=TOKEN_CACHE_SIZE_LIMIT,
+                   eviction_policy='least-recently-stored')
 
 # Give each user its own cookie jar to keep track of cookies that are
 # being set and used between different requests.
 cookie_jars = dict()
+cookie_stats = {"memory_hits": 0, "memory_misses": 0, "disk_hits": 0, "disk_misses": 0, "expired": 0}
+
+# The cookies are shared with the other workers in the same way as the tokens
+cookie_cache = None
+if WORKERS > 1 and STORE_TOKENS_ON_DISK:
+    cookie_cache = DiskCache(join(CACHE_DIR, 'cookie_cache'), size_limit=TOKEN_CACHE_SIZE_LIMIT)
+elif WORKERS > 1 and RUNTIME_DIR:
+    cookie_cache = DiskCache(join(RUNTIME_DIR, 'cookie_cache'), size_limit=TOKEN_CACHE_SIZE_LIMIT)
 
 url_cache = Cache(join(CACHE_DIR, 'url_cache'))
-podcast_cache = Cache(join(CACHE_DIR, 'podcast_cache'))
+
+# When a cache is full, the entries that were stored longest ago are removed
+# first. Unlike 'least-recently-used', this does not write to the disk on every
+# read. Popular podcasts are stored again every time they are refreshed, so
+# they stay in cache anyway. This is also the case for the caches below.
+podcast_cache = Cache(join(CACHE_DIR, 'podcast_cache'), size_limit=PODCAST_CACHE_SIZE_LIMIT,
+                      eviction_policy='least-recently-stored')
 
 # Podcast players support the display of the file size of each episode.
 # Podimo does not provide this information directly, so we do a HEAD request
 # to the episode file locations. This gives us the Content-Length which is
 # the file size of the episode. The file size of an episode doesn't change often,
 # which makes it perfect for caching.
-head_cache = Cache(join(CACHE_DIR, 'head_cache'))
+head_cache = Cache(join(CACHE_DIR, 'head_cache'), size_limit=HEAD_CACHE_SIZE_LIMIT,
+                   eviction_policy='least-recently-stored')
+
+# Rendering a feed is expensive for podcasts with many episodes, while most
+# podcast apps poll the same feed over and over again. Therefore, the rendered
+# feed is cached too, together with its ETag and the time it was rendered.
+# Every entry is tagged with the podcast id, so all rendered variants of a
+# podcast can be dropped at once when its episodes are fetched again.
+feed_cache = Cache(join(CACHE_DIR, 'feed_cache'), tag_index=True, size_limit=FEED_CACHE_SIZE_LIMIT,
+                   eviction_policy='least-recently-stored')
+
+# Most episodes don't change between two renders of a feed, so the rendered
+# <item> of every episode is cached as well. Each entry contains a hash of all
+# fields that were used to render the item, so a changed episode (or a changed
+# file size in the `head_cache`) is rendered again.
+item_cache = Cache(join(CACHE_DIR, 'item_cache'), size_limit=ITEM_CACHE_SIZE_LIMIT,
+                   eviction_policy='least-recently-stored')
+
+# The last rendered feed of every podcast is kept for a long time, so that it
+# can be served when Podimo is unavailable
+fallback_cache = Cache(join(CACHE_DIR, 'fallback_cache'), size_limit=FALLBACK_CACHE_SIZE_LIMIT,
+                       eviction_policy='least-recently-stored')
+
+caches = {
+    "tokens": TOKENS,
+    "url_cache": url_cache,
+    "podcast_cache": podcast_cache,
+    "head_cache": head_cache,
+    "feed_cache": feed_cache,
+    "item_cache": item_cache,
+    "fallback_cache": fallback_cache,
+}
 
 def getCacheEntry(key: str, cache, delete=True):
-    if key in cache:
-        timestamp, value = cache[key]
-        if timestamp < time():
-            if delete:
-                del cache[key]
-            return None
-        else:
-            return value
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    timestamp, value = entry
+    if timestamp < time():
+        cache.stats["expired"] += 1
+        if delete:
+            del cache[key]
+        return None
+    return value
+
+# Like `getCacheEntry`, but expired entries are returned for another
+# `stale_time` seconds. Returns a tuple of the value, whether it is stale,
+# and the time at which it expires.
+def getStaleCacheEntry(key: str, cache, stale_time):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    timestamp, value = entry
+    now = time()
+    if timestamp + stale_time < now:
+        cache.stats["expired"] += 1
+        cache.delete(key)
+        return None
+    return value, timestamp < now, timestamp
+
+# Podcasts are stored in the compact form of `podimo.codec`. The time at which
+# the entry expires is added to the podcast as "expires".
+def getPodcastEntry(key: str):
+    entry = getStaleCacheEntry(key, podcast_cache, PODCAST_STALE_TIME)
+    if entry is None:
+        return None
+    blob, stale, expires = entry
+    # Podcasts that were cached before the compact form was introduced are fetched again
+    if not isinstance(blob, bytes):
+        return None
+    podcast = decodePodcast(blob)
+    podcast["expires"] = expires
+    return podcast, stale
+
+# Returns the time at which the cached podcast expires, or None when it is not
+# in cache. A podcast that is cached again gets a new expiry time.
+def getPodcastExpiry(key: str):
+    entry = podcast_cache.get(key)
+    if entry is None:
+        return None
+    timestamp, _ = entry
+    return timestamp
+
+def getCacheTimeLeft(key: str, cache):
+    entry = cache.get(key)
+    if entry is None:
+        return 0
+    timestamp, _ = entry
+    return max(0, timestamp - time())
 
 def getHeadEntry(id: str):
-    return getCacheEntry(id, head_cache, False)
+    return getCacheEntry(id, head_cache)
 
-def insertCacheEntry(key, value, timeout, cache):
-    cache[key] = (time() + timeout, value)
+# Entries are removed from the cache `grace` seconds after they expired
+# Returns the time at which the entry expires
+def insertCacheEntry(key, value, timeout, cache, grace=0, tag=None):
+    timestamp = time() + timeout
+    cache.set(key, (timestamp, value), expire=timeout + grace, tag=tag)
+    return timestamp
 
 def insertIntoTokenCache(key, value):
     insertCacheEntry(key, value, TOKEN_CACHE_TIME, TOKENS)
 
-def insertIntoHeadCache(key, content_length, content_type):
-    insertCacheEntry(key, (content_length, content_type), HEAD_CACHE_TIME, head_cache)
+def insertIntoHeadCache(key, content_length, content_type, timeout=HEAD_CACHE_TIME):
+    insertCacheEntry(key, (content_length, content_type), timeout, head_cache)
 
 def insertIntoPodcastCache(key, podcast):
-    insertCacheEntry(key, podcast, PODCAST_CACHE_TIME, podcast_cache)
+    podcast["expires"] = insertCacheEntry(key, encodePodcast(podcast), PODCAST_CACHE_TIME,
+                                          podcast_cache, PODCAST_STALE_TIME)
+    invalidateFeedCache(key)
+
+# Returns the cookie jar of a user. A worker that has not seen the user before
+# starts with the cookies that were stored by another worker. The cookies are
+# stored in the same way as `CookieJar.save` and `CookieJar.load` do.
+def getCookieJar(key: str):
+    jar = cookie_jars.get(key)
+    if jar is not None:
+        cookie_stats["memory_hits"] += 1
+        return jar
+
+    cookie_stats["memory_misses"] += 1
+    jar = CookieJar()
+    if cookie_cache is not None:
+        cookies = cookie_cache.get(key)
+        if cookies is not None:
+            cookie_stats["disk_hits"] += 1
+            jar._cookies.update(cookies)
+        else:
+            cookie_stats["disk_misses"] += 1
+    cookie_jars[key] = jar
+    return jar
+
+def storeCookieJar(key: str, jar):
+    if cookie_cache is not None:
+        cookie_cache.set(key, dict(jar._cookies), expire=TOKEN_CACHE_TIME)
+
+def getItemEntry(id: str, digest: str):
+    entry = getCacheEntry(id, item_cache)
+    if entry:
+        item_digest, item = entry
+        if item_digest == digest:
+            return item
+    return None
+
+def insertIntoItemCache(id, digest, item):
+    insertCacheEntry(id, (digest, item), HEAD_CACHE_TIME, item_cache)
+
+# The number of hits and misses of each tier of the caches, and the number of
+# expired entries that were found
+def cacheStats():
+    stats = {name: dict(cache.stats) for name, cache in caches.items()}
+    stats["cookie_jars"] = dict(cookie_stats)
+    return stats
+
+# Periodically removes expired entries from all caches, and removes the least
+# recently stored entries from caches that are larger than their size limit.
+# Every worker cleans up its own memory, but only one of them cleans up the
+# caches on disk.
+async def sweepCaches():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+        sweepDisk = leader is None or leader.isLeader()
+        for name, cache in caches.items():
+            try:
+                cache.expireMemory()
+                if sweepDisk:
+                    await loop.run_in_executor(None, cache.expireDisk)
+            except Exception as e:
+                logging.error(f"Error while sweeping {name}: {e}")
+
+def getFeedEntry(key: str):
+    return getCacheEntry(key, feed_cache)
+
+def insertIntoFeedCache(key, podcast_id, feed, timeout):
+    insertCacheEntry(key, feed, timeout, feed_cache, tag=podcast_id)
+
+def getFallbackEntry(key: str):
+    return getCacheEntry(key, fallback_cache)
+
+def insertIntoFallbackCache(key, feed):
+    insertCacheEntry(key, feed, FALLBACK_CACHE_TIME, fallback_cache)
+
+def invalidateFeedCache(podcast_id):
+    feed_cache.evict(podcast_id)
 
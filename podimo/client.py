@@ -17,15 +17,66 @@
 # See the Licence for the specific language governing
 # permissions and limitations under the Licence.
 
-from podimo.config import GRAPHQL_URL, SCRAPER_API, ZENROWS_API
+from podimo.config import (GRAPHQL_URL, SCRAPER_API, PODCAST_FULL_SYNC_TIME,
+                           PODCAST_CACHE_TIME, GRAPHQL_PAGE_CONCURRENCY, PREWARM_BATCH_SIZE)
 from podimo.utils import (is_correct_email_address, token_key,
-                          randomFlyerId, generateHeaders as gHdrs,
-                          async_wrap)
-from podimo.cache import insertIntoPodcastCache, getCacheEntry, podcast_cache
-from time import time
+                          randomFlyerId, generateHeaders as gHdrs)
+from podimo.cache import insertIntoPodcastCache, getPodcastEntry, getCacheTimeLeft, podcast_cache
+from podimo.singleflight import SingleFlight
+from podimo.locks import fill_locks
+from podimo.scheduler import refresh_scheduler
+from podimo.scrapers import scraper_pool
+from podimo.transport import transport, QueueFullError
+from podimo.breaker import circuit_breaker
+from podimo.metrics import graphql_duration, graphql_errors
+from podimo.timing import measure
+from podimo.ratelimit import rate_limiter
+from time import time, perf_counter
+import asyncio
 import logging
-if ZENROWS_API is not None:
-    from zenrows import ZenRowsClient
+import re
+
+# The name of the operation of a GraphQL query, like "ChannelEpisodesQuery"
+operation_pattern = re.compile(r"query\s+(\w+)")
+
+# Podimo returns the episodes of a podcast in pages of this size
+EPISODES_PER_PAGE = 100
+
+EPISODE_FRAGMENT = """
+            fragment EpisodeBase on PodcastEpisode {
+                id
+                artist
+                podcastName
+                imageUrl
+                description
+                datetime
+                publishDatetime
+                title
+                audio {
+                url
+                duration
+                }
+                streamMedia {
+                duration
+                url
+                }
+            }
+"""
+
+PODCAST_FIELDS = """
+                title
+                description
+                webAddress
+                authorName
+                language
+                images {
+                    coverImageUrl
+                }
+"""
+
+# Concurrent requests for the same podcast share a single fetch from Podimo,
+# also when they are handled by different workers
+podcast_flights = SingleFlight("podcast fetch", fill_locks)
 
 class PodimoClient:
     def __init__(self, username: str, password: str, region: str, locale: str):
@@ -44,29 +95,55 @@ class PodimoClient:
 
         self.key = token_key(username, password)
         self.token = None
+        # Whether the last podcast that was returned by `getPodcasts` was expired
+        self.stale = False
 
     def generateHeaders(self, authorization):
         return gHdrs(authorization, self.locale)
 
     async def post(self, headers, query, variables, scraper):
+        match = operation_pattern.search(query)
+        operation = match.group(1) if match else "unknown"
+        circuit_breaker.check()
+        await rate_limiter.acquire(self.key)
+        start = perf_counter()
+        try:
+            return await self.send(headers, query, variables, scraper)
+        except Exception:
+            graphql_errors.inc(operation=operation)
+            raise
+        finally:
+            graphql_duration.observe(perf_counter() - start, operation=operation)
+
+    async def send(self, headers, query, variables, scraper):
         if SCRAPER_API is not None:
             POST_URL = f"https://api.scraperapi.com?api_key={SCRAPER_API}&url={GRAPHQL_URL}&keep_headers=true"
-        elif ZENROWS_API is not None:
-            scraper = ZenRowsClient(ZENROWS_API)
-            POST_URL = GRAPHQL_URL
         else:
             POST_URL = GRAPHQL_URL
-        response = await async_wrap(scraper.post)(POST_URL,
-                                        headers=headers,
-                                        cookies=self.cookie_jar,
-                                        json={"query": query, "variables": variables},
-                                        timeout=(6.05, 30)
-                                    )
-        if response is None:
+        try:
+            status, response = await transport.post(POST_URL, headers, self.cookie_jar,
+                                                    {"query": query, "variables": variables},
+                                                    scraper)
+        except QueueFullError:
+            raise
+        except Exception:
+            scraper_pool.markBroken(scraper)
+            circuit_breaker.failure()
+            raise
+        # Start over with a new scraper when this one failed, for example
+        # because it got blocked by Cloudflare
+        if status is None:
+            scraper_pool.markBroken(scraper)
+            circuit_breaker.failure()
             raise RuntimeError(f"Could not receive response for query: {query.strip()[:30]}...")
-        if response.status_code != 200:
-            raise RuntimeError(f"Podimo returned an error code. Response code was: {response.status_code} for query \"{query.strip()[:30]}...\"")
-        result = response.json()["data"]
+        if status != 200:
+            scraper_pool.markBroken(scraper)
+            # Other errors are caused by the request itself, not by Podimo being unavailable
+            if status >= 500 or status in (403, 429):
+                circuit_breaker.failure()
+            raise RuntimeError(f"Podimo returned an error code. Response code was: {status} for query \"{query.strip()[:30]}...\"")
+        circuit_breaker.success()
+        result = response["data"]
         if result is None:
             raise RuntimeError(f"Podimo returned no valid data for query {query.strip()[:30]}")
         return result
@@ -153,14 +230,86 @@ class PodimoClient:
             else:
                 raise ValueError("Invalid Podimo credentials, did not receive token")
 
-    async def getPodcasts(self, podcast_id, scraper):
-        podcast = getCacheEntry(podcast_id, podcast_cache)
-        if podcast:
-            timestamp, _ = podcast_cache[podcast_id]
+    # The methods that may have to fetch a podcast take a scraper from the pool
+    # themselves, and only when they need it. A fetch is shared with other
+    # requests, so it has its own scraper instead of the one of the first caller.
+    async def getPodcasts(self, podcast_id):
+        entry = getPodcastEntry(podcast_id)
+        if entry:
+            podcast, stale = entry
+            self.stale = stale
             podcastName = self.getPodcastName(podcast)
-            logging.debug(f"Got podcast '{podcastName}' ({podcast_id}) from cache ({int(timestamp-time())} seconds left)")
+            if stale:
+                # Serve the expired podcast, while it is refreshed in the background
+                logging.debug(f"Got expired podcast '{podcastName}' ({podcast_id}) from cache, refreshing in the background")
+                refresh_scheduler.refreshSoon(podcast_id, self)
+            else:
+                timeLeft = getCacheTimeLeft(podcast_id, podcast_cache)
+                logging.debug(f"Got podcast '{podcastName}' ({podcast_id}) from cache ({int(timeLeft)} seconds left)")
             return podcast
 
+        return await self.refreshPodcasts(podcast_id)
+
+    # Returns at most `limit` episodes of a podcast, starting at `offset`, and
+    # whether there are more episodes after them. Only the episodes in this
+    # window are fetched from Podimo, unless the podcast is in cache already.
+    async def getEpisodeWindow(self, podcast_id, limit, offset):
+        entry = getPodcastEntry(podcast_id)
+        if entry:
+            podcast, stale = entry
+            self.stale = stale
+            if stale:
+                refresh_scheduler.refreshSoon(podcast_id, self)
+            episodes = podcast["episodes"]
+            window = {"episodes": episodes[offset:offset + limit], "podcast": podcast["podcast"],
+                      "expires": podcast["expires"]}
+            return window, len(episodes) > offset + limit
+
+        self.stale = False
+        # One more episode is fetched to find out whether there are more
+        size = limit + 1
+        result = await podcast_flights.do(
+            f"{podcast_id}~{size}~{offset}", lambda: self.fetchEpisodeWindow(podcast_id, size, offset)
+        )
+        episodes = result["episodes"]
+        return {"episodes": episodes[:limit], "podcast": result["podcast"], "expires": None}, len(episodes) > limit
+
+    # Podimo returns at most EPISODES_PER_PAGE episodes per request, so a larger
+    # window is fetched in more than one request
+    async def fetchEpisodeWindow(self, podcast_id, limit, offset):
+        async with scraper_pool.acquire() as scraper:
+            result = await self.fetchEpisodes(podcast_id, min(limit, EPISODES_PER_PAGE), offset, scraper)
+            numEpisodes = len(result["episodes"])
+            while numEpisodes == EPISODES_PER_PAGE and len(result["episodes"]) < limit:
+                size = min(limit - len(result["episodes"]), EPISODES_PER_PAGE)
+                page = await self.fetchEpisodes(podcast_id, size, offset + len(result["episodes"]), scraper)
+                numEpisodes = len(page["episodes"])
+                result["episodes"] += page["episodes"]
+            return result
+
+    async def refreshPodcasts(self, podcast_id):
+        started = time()
+        return await podcast_flights.do(podcast_id, lambda: self.syncPodcasts(podcast_id, started))
+
+    # Only fetch the episodes that are newer than the ones that are already in
+    # cache, unless it has been too long since all episodes were fetched.
+    async def syncPodcasts(self, podcast_id, started):
+        # Read the podcast from disk, as another worker may have refreshed it
+        # while this one was waiting for its turn
+        podcast_cache.forget(podcast_id)
+        entry = getPodcastEntry(podcast_id)
+        if entry:
+            previous, _ = entry
+            if getCacheTimeLeft(podcast_id, podcast_cache) > PODCAST_CACHE_TIME - (time() - started):
+                logging.debug(f"Podcast {podcast_id} was refreshed by another worker")
+                return previous
+            if time() - previous.get("fullSync", 0) < PODCAST_FULL_SYNC_TIME:
+                async with scraper_pool.acquire() as scraper:
+                    return await self.fetchNewPodcasts(podcast_id, previous, scraper)
+        async with scraper_pool.acquire() as scraper:
+            return await self.fetchPodcasts(podcast_id, scraper)
+
+    async def fetchEpisodes(self, podcast_id, limit, offset, scraper):
         headers = self.generateHeaders(self.token)
         logging.debug("ChannelEpisodesQuery")
         query = """
@@ -175,66 +324,179 @@ class PodimoClient:
                 ) {
                 ...EpisodeBase
                 }
-                podcast: podcastById(podcastId: $podcastId) {
-                title
-                description
-                webAddress
-                authorName
-                language
-                images {
-                    coverImageUrl
-                }
-                }
+                podcast: podcastById(podcastId: $podcastId) {""" + PODCAST_FIELDS + """}
             }
+        """ + EPISODE_FRAGMENT
+        variables = {
+            "podcastId": podcast_id,
+            "limit": limit,
+            "offset": offset,
+            "sorting": "PUBLISHED_DESCENDING",
+        }
+        with measure("page", f"offset {offset}"):
+            return await self.post(headers, query, variables, scraper)
 
-            fragment EpisodeBase on PodcastEpisode {
-                id
-                artist
-                podcastName
-                imageUrl
-                description
-                datetime
-                publishDatetime
-                title
-                audio {
-                url
-                duration
-                }
-                streamMedia {
-                duration
-                url
-                }
-            }
-        """
+    # Fetches all episodes of a podcast. The `first` page of episodes can be
+    # given if it was already fetched.
+    async def fetchPodcasts(self, podcast_id, scraper, first=None):
+        limit = EPISODES_PER_PAGE
+        fullResult = first
+        if fullResult is None:
+            fullResult = await self.fetchEpisodes(podcast_id, limit, 0, scraper)
+        podcastName = self.getPodcastName(fullResult)
+        logging.debug(f"Fetched podcast '{podcastName}' ({podcast_id}) directly")
 
-        limit = 100
-        offset = 0
-        while True:
-            variables = {
-                "podcastId": podcast_id,
-                "limit": limit,
-                "offset": offset,
-                "sorting": "PUBLISHED_DESCENDING",
-            }
-            result = await self.post(headers, query, variables, scraper)
-            if offset == 0:
-                # podcastName = result[0]['podcastName']
-                podcastName = self.getPodcastName(result)
-                logging.debug(f"Fetched podcast '{podcastName}' ({podcast_id}) directly")
-                fullResult = result
-            else:
+        # The total number of episodes is unknown up front, so the next pages are
+        # fetched concurrently in batches of GRAPHQL_PAGE_CONCURRENCY pages until
+        # one of them is not full. Most podcasts have only one or two pages, so
+        # the second page is fetched on its own, and pages are only fetched
+        # concurrently after two full pages.
+        # A scraper is not safe to use from multiple threads, so the pages are
+        # fetched one after another when the transport sends them with the scraper.
+        concurrency = GRAPHQL_PAGE_CONCURRENCY if transport.shareable else 1
+        batch = 1
+        offset = limit
+        numEpisodes = len(fullResult["episodes"])
+        while numEpisodes == limit:
+            logging.debug(f"Fetched {numEpisodes} episodes; fetching more...")
+            offsets = [offset + i * limit for i in range(batch)]
+            results = await asyncio.gather(
+                *[self.fetchEpisodes(podcast_id, limit, o, scraper) for o in offsets]
+            )
+            for result in results:
+                numEpisodes = len(result["episodes"])
                 fullResult["episodes"] += result["episodes"]
-            numEpisodes = len(result["episodes"])
-            if numEpisodes == limit:
-                logging.debug(f"Fetched {numEpisodes} episodes; fetching more...")
-                offset += limit
-            else:
-                logging.debug(f"Fetched {numEpisodes} episodes; no more to fetch")
+                if numEpisodes < limit:
+                    break
+            offset = offsets[-1] + limit
+            batch = concurrency
+        logging.debug(f"Fetched {numEpisodes} episodes; no more to fetch")
+
+        fullResult["fullSync"] = time()
+        insertIntoPodcastCache(podcast_id, fullResult)
+        return fullResult
+
+    # Fetch the newest episodes until an episode is found that is already in
+    # `previous`, and put the new episodes in front of the previous ones.
+    async def fetchNewPodcasts(self, podcast_id, previous, scraper):
+        known = set(episode["id"] for episode in previous["episodes"])
+        newEpisodes = []
+        limit = EPISODES_PER_PAGE
+        offset = 0
+        found = False
+        while not found:
+            result = await self.fetchEpisodes(podcast_id, limit, offset, scraper)
+            for episode in result["episodes"]:
+                if episode["id"] in known:
+                    found = True
+                    break
+                newEpisodes.append(episode)
+            if len(result["episodes"]) < limit:
                 break
-        
+            offset += limit
+
+        podcastName = self.getPodcastName(result)
+        if found:
+            logging.debug(f"Fetched {len(newEpisodes)} new episodes of podcast '{podcastName}' ({podcast_id})")
+            fullResult = {
+                "episodes": newEpisodes + previous["episodes"],
+                "podcast": result["podcast"],
+                "fullSync": previous["fullSync"],
+            }
+        else:
+            # None of the previous episodes exist anymore, so all episodes were fetched
+            logging.debug(f"Fetched all {len(newEpisodes)} episodes of podcast '{podcastName}' ({podcast_id})")
+            fullResult = {
+                "episodes": newEpisodes,
+                "podcast": result["podcast"],
+                "fullSync": time(),
+            }
         insertIntoPodcastCache(podcast_id, fullResult)
         return fullResult
 
+    # Fetches the first page of episodes of multiple podcasts with a single
+    # request, by giving every podcast its own alias in the query. Returns a
+    # dictionary with the first page of every podcast, in the same form as
+    # `fetchEpisodes`. Podcasts that were not found are None.
+    async def fetchFirstPages(self, podcast_ids, scraper):
+        headers = self.generateHeaders(self.token)
+        logging.debug(f"BatchEpisodesQuery for {len(podcast_ids)} podcasts")
+        parameters = "".join(f", $podcast{i}: String!" for i in range(len(podcast_ids)))
+        fields = "".join(f"""
+                episodes{i}: podcastEpisodes(
+                podcastId: $podcast{i}
+                converted: true
+                published: true
+                limit: $limit
+                offset: 0
+                sorting: $sorting
+                ) {{
+                ...EpisodeBase
+                }}
+                podcast{i}: podcastById(podcastId: $podcast{i}) {{{PODCAST_FIELDS}}}""" for i in range(len(podcast_ids)))
+        query = f"""
+            query BatchEpisodesQuery($limit: Int!, $sorting: PodcastEpisodeSorting{parameters}) {{{fields}
+            }}
+        """ + EPISODE_FRAGMENT
+        variables = {"limit": EPISODES_PER_PAGE, "sorting": "PUBLISHED_DESCENDING"}
+        for i, podcast_id in enumerate(podcast_ids):
+            variables[f"podcast{i}"] = podcast_id
+        result = await self.post(headers, query, variables, scraper)
+
+        pages = dict()
+        for i, podcast_id in enumerate(podcast_ids):
+            podcast = result.get(f"podcast{i}")
+            episodes = result.get(f"episodes{i}")
+            if podcast is None or episodes is None:
+                pages[podcast_id] = None
+            else:
+                pages[podcast_id] = {"episodes": episodes, "podcast": podcast}
+        return pages
+
+    # Makes sure that the given podcasts are in cache, while fetching the first
+    # page of episodes of PREWARM_BATCH_SIZE podcasts at once. Returns a
+    # dictionary with the podcasts that are in cache now.
+    async def prewarmPodcasts(self, podcast_ids):
+        podcasts = dict()
+        missing = []
+        for podcast_id in podcast_ids:
+            entry = getPodcastEntry(podcast_id)
+            if entry and not entry[1]:
+                podcasts[podcast_id] = entry[0]
+            else:
+                missing.append(podcast_id)
+
+        for i in range(0, len(missing), PREWARM_BATCH_SIZE):
+            batch = missing[i:i + PREWARM_BATCH_SIZE]
+            try:
+                async with scraper_pool.acquire() as scraper:
+                    pages = await self.fetchFirstPages(batch, scraper)
+            except Exception as e:
+                # A single podcast can make the whole batch fail, so the
+                # podcasts of the batch are fetched one by one instead
+                logging.info(f"Could not pre-warm podcasts {', '.join(batch)} at once, fetching them one by one: {e}")
+                for podcast_id in batch:
+                    try:
+                        podcasts[podcast_id] = await self.refreshPodcasts(podcast_id)
+                    except Exception as e:
+                        logging.error(f"Could not pre-warm podcast {podcast_id}: {e}")
+                continue
+            for podcast_id, first in pages.items():
+                if first is None:
+                    logging.info(f"Podcast {podcast_id} was not found while pre-warming")
+                    continue
+                try:
+                    # Only podcasts with more than one page of episodes need more requests
+                    podcasts[podcast_id] = await podcast_flights.do(
+                        podcast_id, lambda podcast_id=podcast_id, first=first: self.completePodcast(podcast_id, first)
+                    )
+                except Exception as e:
+                    logging.error(f"Could not pre-warm podcast {podcast_id}: {e}")
+        return podcasts
+
+    async def completePodcast(self, podcast_id, first):
+        async with scraper_pool.acquire() as scraper:
+            return await self.fetchPodcasts(podcast_id, scraper, first)
+
     def getPodcastName (self, podcast):
         return list(podcast.values())[1]["title"]
-       
@@ -0,0 +1,95 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+# A compact representation of the podcasts that are stored in the podcast cache.
+#
+# Podimo repeats some fields (like the name of the podcast) for every episode.
+# Fields that are the same for every episode are stored only once, and all
+# other fields are stored per column instead of per episode. The result is
+# pickled and compressed.
+
+import pickle
+import zlib
+
+VERSION = 1
+
+# Fields of an episode that are often the same for all episodes of a podcast
+SHARED_FIELDS = ["podcastName", "artist", "imageUrl"]
+EPISODE_FIELDS = ["id", "artist", "podcastName", "imageUrl", "description",
+                  "datetime", "publishDatetime", "title", "audio", "streamMedia"]
+MEDIA_FIELDS = ["url", "duration"]
+
+def encodeMedia(media):
+    if media is None:
+        return None
+    return tuple(media.get(field) for field in MEDIA_FIELDS)
+
+def decodeMedia(media):
+    if media is None:
+        return None
+    return dict(zip(MEDIA_FIELDS, media))
+
+def encodePodcast(data) -> bytes:
+    episodes = data["episodes"]
+    shared = dict()
+    for field in SHARED_FIELDS:
+        values = set(episode.get(field) for episode in episodes)
+        if len(values) == 1:
+            shared[field] = values.pop()
+
+    columns = dict()
+    for field in EPISODE_FIELDS:
+        if field in shared:
+            continue
+        if field in ("audio", "streamMedia"):
+            columns[field] = [encodeMedia(episode.get(field)) for episode in episodes]
+        else:
+            columns[field] = [episode.get(field) for episode in episodes]
+
+    compact = {
+        "version": VERSION,
+        "podcast": data["podcast"],
+        "fullSync": data.get("fullSync", 0),
+        "count": len(episodes),
+        "shared": shared,
+        "columns": columns,
+    }
+    return zlib.compress(pickle.dumps(compact, pickle.HIGHEST_PROTOCOL))
+
+def decodePodcast(blob: bytes):
+    compact = pickle.loads(zlib.decompress(blob))
+    shared = compact["shared"]
+    columns = compact["columns"]
+    for field in ("audio", "streamMedia"):
+        columns[field] = [decodeMedia(media) for media in columns[field]]
+
+    names = list(columns.keys())
+    episodes = []
+    for values in zip(*columns.values()):
+        episode = dict(shared)
+        episode.update(zip(names, values))
+        episodes.append(episode)
+    if not names:
+        episodes = [dict(shared) for _ in range(compact["count"])]
+
+    return {
+        "episodes": episodes,
+        "podcast": compact["podcast"],
+        "fullSync": compact["fullSync"],
+    }
@@ -53,8 +53,72 @@ PODIMO_EMAIL = config.get("PODIMO_EMAIL", None)
 PODIMO_PASSWORD = config.get("PODIMO_PASSWORD", None)
 
 # Podimo's API uses GraphQL. This variable defines the endpoint where
-# the API can be found.
-GRAPHQL_URL = "https://podimo.com/graphql"
+# the API can be found. It can be changed to test against a stand-in for
+# Podimo, like the one in `bench/`.
+GRAPHQL_URL = str(config.get("GRAPHQL_URL", "https://podimo.com/graphql"))
+
+# The maximum number of scrapers that are used at the same time to talk
+# to Podimo, and after how many seconds a scraper is replaced by a new one
+SCRAPER_POOL_SIZE = max(1, int(config.get("SCRAPER_POOL_SIZE", 10)))
+SCRAPER_MAX_AGE = int(config.get("SCRAPER_MAX_AGE", 30 * 60))  # seconds = 30 minutes by default
+
+# How requests are sent to Podimo. The options are
+# - "cloudscraper", the default. Gets past Cloudflare's bot detection, but
+#                   needs a thread for every request.
+# - "aiohttp", fully asynchronous, but does not get past Cloudflare.
+GRAPHQL_TRANSPORT = str(config.get("GRAPHQL_TRANSPORT", "cloudscraper")).lower()
+# The maximum number of requests to Podimo that are sent at the same time,
+# and the maximum number of requests that may wait for their turn
+GRAPHQL_CONCURRENCY = max(1, int(config.get("GRAPHQL_CONCURRENCY", 8)))
+GRAPHQL_MAX_QUEUE = int(config.get("GRAPHQL_MAX_QUEUE", 100))
+
+# The maximum number of requests per second to Podimo, for all users together
+# (0 = no limit). Short bursts of up to GRAPHQL_BURST requests are allowed.
+# Requests beyond the limit wait for their turn.
+GRAPHQL_RATE_LIMIT = float(config.get("GRAPHQL_RATE_LIMIT", 10))
+GRAPHQL_BURST = int(config.get("GRAPHQL_BURST", 20))
+
+# After BREAKER_THRESHOLD failed requests to Podimo in a row, no requests are
+# sent for a while. This time starts at BREAKER_BACKOFF seconds, and doubles
+# (up to BREAKER_MAX_BACKOFF seconds) every time Podimo is still unavailable.
+BREAKER_THRESHOLD = max(1, int(config.get("BREAKER_THRESHOLD", 5)))
+BREAKER_BACKOFF = float(config.get("BREAKER_BACKOFF", 10))  # seconds
+BREAKER_MAX_BACKOFF = float(config.get("BREAKER_MAX_BACKOFF", 300))  # seconds = 5 minutes by default
+
+# How many pages of episodes are fetched at the same time when all
+# episodes of a podcast are fetched with GRAPHQL_TRANSPORT=aiohttp
+GRAPHQL_PAGE_CONCURRENCY = max(1, int(config.get("GRAPHQL_PAGE_CONCURRENCY", 4)))
+
+# How many podcasts are fetched with one request to Podimo when podcasts are
+# pre-warmed (see `/prewarm` and `prewarm.py`)
+PREWARM_BATCH_SIZE = max(1, int(config.get("PREWARM_BATCH_SIZE", 10)))
+
+# The maximum number of HEAD requests to episode files that are done at the
+# same time, in total and to a single host
+HEAD_CONCURRENCY = max(1, int(config.get("HEAD_CONCURRENCY", 10)))
+HEAD_CONCURRENCY_PER_HOST = max(1, int(config.get("HEAD_CONCURRENCY_PER_HOST", 5)))
+
+# Whether feeds are sent right away, while the sizes of new episodes are
+# looked up in the background
+BACKGROUND_HEAD_REQUESTS = bool(str(config.get("BACKGROUND_HEAD_REQUESTS", None)).lower() in ['true', '1', 't', 'y', 'yes'])
+
+# Every cache keeps its most recently used entries in memory as well. These
+# options define how many entries, and how many bytes (as pickled), each cache
+# keeps in memory at most.
+MEMORY_CACHE_ENTRIES = int(config.get("MEMORY_CACHE_ENTRIES", 10000))
+MEMORY_CACHE_SIZE = int(config.get("MEMORY_CACHE_SIZE", 32 * 1024 * 1024))  # bytes = 32 MiB by default
+
+# The maximum size of each cache on disk, in bytes. When a cache grows beyond
+# its limit, the least recently stored entries are removed.
+TOKEN_CACHE_SIZE_LIMIT = int(config.get("TOKEN_CACHE_SIZE_LIMIT", 16 * 1024 * 1024))  # 16 MiB by default
+PODCAST_CACHE_SIZE_LIMIT = int(config.get("PODCAST_CACHE_SIZE_LIMIT", 512 * 1024 * 1024))  # 512 MiB by default
+HEAD_CACHE_SIZE_LIMIT = int(config.get("HEAD_CACHE_SIZE_LIMIT", 64 * 1024 * 1024))  # 64 MiB by default
+FEED_CACHE_SIZE_LIMIT = int(config.get("FEED_CACHE_SIZE_LIMIT", 512 * 1024 * 1024))  # 512 MiB by default
+ITEM_CACHE_SIZE_LIMIT = int(config.get("ITEM_CACHE_SIZE_LIMIT", 256 * 1024 * 1024))  # 256 MiB by default
+FALLBACK_CACHE_SIZE_LIMIT = int(config.get("FALLBACK_CACHE_SIZE_LIMIT", 512 * 1024 * 1024))  # 512 MiB by default
+
+# How often expired entries are removed from the caches
+CACHE_SWEEP_INTERVAL = int(config.get("CACHE_SWEEP_INTERVAL", 600))  # seconds = 10 minutes by default
 
 # Whether login tokens should be cached on disk, or only in memory
 STORE_TOKENS_ON_DISK = bool(str(config.get("STORE_TOKENS_ON_DISK", True)).lower() in ['true', '1', 't', 'y', 'yes'])
@@ -65,8 +129,51 @@ TOKEN_CACHE_TIME = int(config.get("TOKEN_CACHE_TIME", 3600 * 24 * 5))  # seconds
 # The time that a podcast feed is stored in cache
 PODCAST_CACHE_TIME = int(config.get("PODCAST_CACHE_TIME", "21600"))  # Default = 3600 * 6 = 6 hours
 
+# When a podcast is refreshed, only the new episodes are fetched. All episodes
+# are fetched again once every `PODCAST_FULL_SYNC_TIME`, to pick up changes to
+# older episodes.
+PODCAST_FULL_SYNC_TIME = int(config.get("PODCAST_FULL_SYNC_TIME", 3600 * 24 * 7))  # seconds = 7 days by default
+
+# How long a podcast may be served from cache after it has expired, while it
+# is being refreshed in the background
+PODCAST_STALE_TIME = int(config.get("PODCAST_STALE_TIME", 3600 * 24))  # seconds = 1 day by default
+
+# Popular podcasts are refreshed in the background before they expire. A podcast
+# is popular if it is requested at least `REFRESH_MIN_REQUESTS` times within
+# `PODCAST_CACHE_TIME`, and it is refreshed `REFRESH_AHEAD_TIME` seconds before
+# its cache entry expires.
+REFRESH_MIN_REQUESTS = int(config.get("REFRESH_MIN_REQUESTS", 3))
+REFRESH_AHEAD_TIME = int(config.get("REFRESH_AHEAD_TIME", 15 * 60))  # seconds = 15 minutes by default
+
+# How long the last feed of a podcast is kept, to be served when Podimo is
+# unavailable
+FALLBACK_CACHE_TIME = int(config.get("FALLBACK_CACHE_TIME", 3600 * 24 * 30))  # seconds = 30 days by default
+
 # The time that the content information is cached
 HEAD_CACHE_TIME = int(config.get("HEAD_CACHE_TIME", 7 * 60 * 60 * 24))  # seconds = 7 days by default
+# The time until a HEAD request that failed is tried again. Until then, the
+# episode has a size of 0 in the feed.
+HEAD_FAILURE_CACHE_TIME = int(config.get("HEAD_FAILURE_CACHE_TIME", 60 * 60))  # seconds = 1 hour by default
+
+# The number of worker processes that serve requests. Workers share their
+# caches, login tokens and cookies through CACHE_DIR.
+WORKERS = max(1, int(config.get("WORKERS", 1)))
+# When there are multiple workers, entries are kept in the memory of a worker
+# for at most this long, so that changes by other workers are picked up
+WORKER_MEMORY_CACHE_TIME = int(config.get("WORKER_MEMORY_CACHE_TIME", 10))  # seconds
+
+# Whether metrics are available for Prometheus at /metrics
+METRICS = bool(str(config.get("METRICS", None)).lower() in ['true', '1', 't', 'y', 'yes'])
+
+# Whether the time spent in each phase of a feed request is logged
+TIMING_LOG = bool(str(config.get("TIMING_LOG", None)).lower() in ['true', '1', 't', 'y', 'yes'])
+
+# Feeds can be written to files in EXPORT_DIR, so that they can be served by a
+# web server like nginx. The podcasts that are exported are listed in
+# EXPORT_FEEDS_FILE, and are fetched with PODIMO_EMAIL and PODIMO_PASSWORD.
+EXPORT_DIR = config.get("EXPORT_DIR", None)
+EXPORT_FEEDS_FILE = str(config.get("EXPORT_FEEDS_FILE", "./.export-feeds"))
+EXPORT_INTERVAL = int(config.get("EXPORT_INTERVAL", 15 * 60))  # seconds = 15 minutes by default
 
 # Whether the feeds generated with this tool should show up in public podcast catalogues
 PUBLIC_FEEDS = bool(str(config.get("PUBLIC_FEEDS", None)).lower() in ['true', '1', 't', 'y', 'yes'])
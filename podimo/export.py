@@ -0,0 +1,110 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from podimo.config import CACHE_DIR, LOCALES, REGIONS
+from diskcache import Cache as DiskCache
+from hashlib import sha256
+from os.path import exists, join
+from tempfile import mkstemp
+import gzip
+import logging
+import os
+import re
+
+# The podcast id is used in the name of the exported file, so it may only
+# contain hexadecimal digits and dashes, like in the feed URLs of this tool
+podcast_id_pattern = re.compile(r"[0-9a-fA-F\-]*[0-9a-fA-F][0-9a-fA-F\-]*")
+
+# Reads the feeds that should be exported from a file. Every line contains
+# the id of a podcast, optionally followed by a region and a locale:
+#     12345-abcdef nl nl-NL
+# Lines that start with '#' are ignored, and so are lines with an invalid
+# podcast id, region or locale.
+def readExportList(path):
+    feeds = dict()
+    if not exists(path):
+        return []
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            podcast_id = fields[0]
+            region = fields[1] if len(fields) > 1 else 'nl'
+            locale = fields[2] if len(fields) > 2 else 'nl-NL'
+            if podcast_id_pattern.fullmatch(podcast_id) is None:
+                logging.error(f"Ignoring invalid podcast id '{podcast_id}' in {path}")
+                continue
+            if region not in [region_code for (region_code, _) in REGIONS] or locale not in LOCALES:
+                logging.error(f"Ignoring invalid region or locale of podcast {podcast_id} in {path}")
+                continue
+            # A podcast is exported only once, with the first region and locale
+            feeds.setdefault(podcast_id, (podcast_id, region, locale))
+    return list(feeds.values())
+
+class FeedExporter:
+    """
+    Writes feeds to `<podcast id>.xml` files in `directory`, together with a
+    gzipped `<podcast id>.xml.gz`, so that a web server like nginx can serve
+    them directly. Files are replaced atomically, and only when the episodes
+    of the podcast changed.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        # The fingerprint of the episodes of every exported feed
+        self.fingerprints = DiskCache(join(CACHE_DIR, 'export_cache'))
+
+    def path(self, podcast_id):
+        return join(self.directory, f"{podcast_id}.xml")
+
+    def fingerprint(self, data):
+        ids = "\n".join(episode["id"] for episode in data["episodes"])
+        return sha256(ids.encode("utf-8")).hexdigest()
+
+    def isCurrent(self, podcast_id, fingerprint):
+        path = self.path(podcast_id)
+        if not exists(path) or not exists(path + ".gz"):
+            return False
+        return self.fingerprints.get(podcast_id) == fingerprint
+
+    # A feed that is not `complete` is written again the next time, when the
+    # sizes of all its episodes are known
+    def write(self, podcast_id, body, fingerprint, complete):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(podcast_id)
+        self.writeAtomically(path + ".gz", gzip.compress(body, compresslevel=9, mtime=0))
+        self.writeAtomically(path, body)
+        if complete:
+            self.fingerprints.set(podcast_id, fingerprint)
+        else:
+            self.fingerprints.delete(podcast_id)
+
+    # Writes to a temporary file first, and moves it into place, so a web
+    # server never serves a partially written feed
+    def writeAtomically(self, path, data):
+        fd, temporary = mkstemp(dir=self.directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
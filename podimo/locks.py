@@ -0,0 +1,84 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from podimo.config import CACHE_DIR, WORKERS, CACHE_SWEEP_INTERVAL
+from contextlib import asynccontextmanager
+from diskcache import Cache as DiskCache
+from os.path import join
+from uuid import uuid4
+import asyncio
+import logging
+
+# How often a worker checks whether a lock that is held by another worker
+# has been released
+LOCK_POLL_INTERVAL = 0.05
+
+class FillLocks:
+    """
+    Locks that are shared between all worker processes, so that only one
+    worker fills a cache entry at the same time. A lock is an entry in a
+    `diskcache.Cache`, which is added atomically. Locks expire after `timeout`
+    seconds, so a worker that crashed does not hold on to its locks forever.
+    """
+    def __init__(self, store, timeout: int):
+        self.store = store
+        self.timeout = timeout
+
+    @asynccontextmanager
+    async def hold(self, key):
+        owner = uuid4().hex
+        if not self.store.add(key, owner, expire=self.timeout):
+            logging.debug(f"Waiting for another worker to release {key}")
+            while not self.store.add(key, owner, expire=self.timeout):
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            with self.store.transact():
+                if self.store.get(key) == owner:
+                    self.store.delete(key)
+
+class Leader:
+    """
+    Elects one of the worker processes to do work that only has to be done
+    once, like removing expired entries from the caches on disk. The leader
+    keeps its position as long as it asks for it at least once every `lease`
+    seconds.
+    """
+    def __init__(self, store, lease: int):
+        self.store = store
+        self.lease = lease
+        self.id = uuid4().hex
+
+    def isLeader(self):
+        with self.store.transact():
+            leader = self.store.get("leader")
+            if leader is None or leader == self.id:
+                self.store.set("leader", self.id, expire=self.lease)
+                return True
+        return False
+
+# Locks are only needed when there are multiple workers
+lock_store = None
+fill_locks = None
+leader = None
+if WORKERS > 1:
+    lock_store = DiskCache(join(CACHE_DIR, 'locks'))
+    fill_locks = FillLocks(lock_store, timeout=300)
+    leader = Leader(lock_store, lease=3 * CACHE_SWEEP_INTERVAL)
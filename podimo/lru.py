@@ -0,0 +1,156 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from collections import OrderedDict
+from time import time
+import pickle
+
+MISSING = object()
+
+class TieredCache:
+    """
+    Keeps the most recently used entries of a `diskcache.Cache` in memory, so
+    they don't have to be read from disk and unpickled again. Writes go to both
+    tiers. At most `max_entries` entries, with a combined pickled size of at most
+    `max_bytes`, are kept in memory. Without a `disk`, the cache only lives in
+    memory.
+
+    Entries that are set with an `expire` time (in seconds) disappear from
+    both tiers once that time has passed. With a `max_age`, entries are kept
+    in memory for at most `max_age` seconds, after which they are read from
+    disk again. This lets multiple processes share the same cache on disk.
+
+    Values that are returned from the cache are shared between callers, and
+    should not be modified.
+    """
+    def __init__(self, disk, max_entries: int, max_bytes: int, max_age=None):
+        self.disk = disk
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # Maps each key to a tuple of the value, its size, its tag and
+        # the time at which it expires
+        self.memory = OrderedDict()
+        self.size = 0
+        self.stats = {
+            "memory_hits": 0,
+            "memory_misses": 0,
+            "disk_hits": 0,
+            "disk_misses": 0,
+            # Entries that were found, but had expired (see `podimo.cache`)
+            "expired": 0,
+        }
+
+    def get(self, key, default=None):
+        entry = self.memory.get(key)
+        if entry is not None:
+            expire_time = entry[3]
+            if expire_time is None or expire_time > time():
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry[0]
+            self.forget(key)
+        self.stats["memory_misses"] += 1
+        if self.disk is None:
+            return default
+
+        value, expire_time, tag = self.disk.get(key, default=MISSING, expire_time=True, tag=True)
+        if value is MISSING:
+            self.stats["disk_misses"] += 1
+            return default
+        self.stats["disk_hits"] += 1
+        self.remember(key, value, tag, expire_time)
+        return value
+
+    def set(self, key, value, expire=None, tag=None):
+        expire_time = None
+        if expire is not None:
+            expire_time = time() + expire
+        if self.disk is not None:
+            self.disk.set(key, value, expire=expire, tag=tag)
+        self.remember(key, value, tag, expire_time)
+
+    def delete(self, key):
+        found = self.forget(key)
+        if self.disk is not None:
+            return self.disk.delete(key)
+        return found
+
+    def evict(self, tag):
+        for key in [key for key, entry in self.memory.items() if entry[2] == tag]:
+            self.forget(key)
+        if self.disk is not None:
+            return self.disk.evict(tag)
+
+    def clear(self):
+        self.memory.clear()
+        self.size = 0
+        if self.disk is not None:
+            return self.disk.clear()
+
+    # Removes the expired entries from memory
+    def expireMemory(self):
+        now = time()
+        for key in [key for key, entry in self.memory.items() if entry[3] is not None and entry[3] <= now]:
+            self.forget(key)
+
+    # Removes the expired entries from disk, and removes entries when the cache
+    # is larger than its size limit. This is blocking, and may be slow.
+    def expireDisk(self):
+        if self.disk is not None:
+            self.disk.expire()
+            self.disk.cull()
+
+    def remember(self, key, value, tag, expire_time):
+        self.forget(key)
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        if self.max_age is not None:
+            max_time = time() + self.max_age
+            if expire_time is None or expire_time > max_time:
+                expire_time = max_time
+        self.memory[key] = (value, size, tag, expire_time)
+        self.size += size
+        while len(self.memory) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size, _, _) = self.memory.popitem(last=False)
+            self.size -= evicted_size
+
+    def forget(self, key):
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+            return True
+        return False
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
@@ -0,0 +1,191 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+# Metrics in the text format of Prometheus, see
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# Every worker process keeps its own metrics. When there are multiple workers,
+# each scrape of `/metrics` is answered by one of them.
+
+from podimo.transport import transport
+import podimo.cache as cache
+from bisect import bisect_left
+
+# Upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def formatLabels(names, values, extra=""):
+    labels = [f'{name}="{escapeLabel(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric:
+    """
+    A metric with a value for every combination of label values. Instead of
+    keeping track of its values, a metric can also `collect` them when the
+    metrics are rendered. `collect` then returns a dictionary that maps a
+    tuple of label values to a value.
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.values = dict()
+        if not self.labels:
+            self.values[()] = 0
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        values = self.values if self.collect is None else self.collect()
+        for labels, value in sorted(values.items()):
+            yield self.name + formatLabels(self.labels, labels) + " " + formatValue(value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.values.clear()
+
+    # Every value is a list with the number of observations in each bucket,
+    # followed by the number of observations and their sum
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = [0] * (len(self.buckets) + 2)
+            self.values[key] = counts
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket = formatLabels(self.labels, labels, f'le="{formatValue(bound)}"')
+                yield f"{self.name}_bucket{bucket} {cumulative}"
+            yield f"{self.name}_count{formatLabels(self.labels, labels)} {counts[-2]}"
+            yield f"{self.name}_sum{formatLabels(self.labels, labels)} {formatValue(counts[-1])}"
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+registry = Registry()
+
+http_requests = registry.add(Counter(
+    "podimo_http_requests_total", "Number of handled HTTP requests", ["route", "method", "status"]))
+http_duration = registry.add(Histogram(
+    "podimo_http_request_duration_seconds", "Time until the response to an HTTP request was ready", ["route"]))
+fallback_feeds = registry.add(Counter(
+    "podimo_fallback_feeds_total", "Number of feeds that were served from the fallback cache, because Podimo failed"))
+graphql_duration = registry.add(Histogram(
+    "podimo_graphql_request_duration_seconds", "Duration of GraphQL requests to Podimo", ["operation"]))
+graphql_errors = registry.add(Counter(
+    "podimo_graphql_errors_total", "Number of failed GraphQL requests to Podimo", ["operation"]))
+head_duration = registry.add(Histogram(
+    "podimo_head_request_duration_seconds", "Duration of HEAD requests to episode files"))
+head_retries = registry.add(Counter(
+    "podimo_head_retries_total", "Number of retried HEAD requests to episode files"))
+head_errors = registry.add(Counter(
+    "podimo_head_errors_total", "Number of HEAD requests to episode files that failed after all retries"))
+head_in_flight = registry.add(Gauge(
+    "podimo_head_requests_in_flight", "Number of HEAD requests to episode files that are in progress"))
+
+def cacheCounts(result):
+    def collect():
+        values = dict()
+        for name, stats in cache.cacheStats().items():
+            for tier in ("memory", "disk"):
+                values[(name, tier)] = stats[f"{tier}_{result}"]
+        return values
+    return collect
+
+registry.add(Counter(
+    "podimo_cache_hits_total", "Number of cache lookups that found an entry",
+    ["cache", "tier"], collect=cacheCounts("hits")))
+registry.add(Counter(
+    "podimo_cache_misses_total", "Number of cache lookups that did not find an entry",
+    ["cache", "tier"], collect=cacheCounts("misses")))
+registry.add(Counter(
+    "podimo_cache_expired_total", "Number of cache lookups that found an expired entry",
+    ["cache"], collect=lambda: {(name,): stats["expired"] for name, stats in cache.cacheStats().items()}))
+registry.add(Gauge(
+    "podimo_cache_memory_entries", "Number of entries of each cache that are kept in memory",
+    ["cache"], collect=lambda: {(name,): len(c.memory) for name, c in cache.caches.items()}))
+registry.add(Gauge(
+    "podimo_cache_memory_bytes", "Pickled size of the entries of each cache that are kept in memory",
+    ["cache"], collect=lambda: {(name,): c.size for name, c in cache.caches.items()}))
+registry.add(Gauge(
+    "podimo_graphql_requests_in_flight", "Number of GraphQL requests to Podimo that are in progress",
+    collect=lambda: {(): transport.inFlight()}))
+registry.add(Gauge(
+    "podimo_graphql_queue_depth", "Number of GraphQL requests to Podimo that wait for their turn",
+    collect=lambda: {(): transport.queueDepth()}))
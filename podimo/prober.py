@@ -0,0 +1,143 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from podimo.config import HEAD_CONCURRENCY, HEAD_CONCURRENCY_PER_HOST, HEAD_FAILURE_CACHE_TIME
+from podimo.utils import generateHeaders
+from podimo.metrics import registry, Gauge, head_duration, head_retries, head_errors, head_in_flight
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from mimetypes import guess_type
+from time import perf_counter
+import podimo.cache as cache
+import asyncio
+import logging
+
+class HeadProber:
+    """
+    Does the HEAD requests that find out the size and type of episode files.
+    All feeds share the same connections, at most `concurrency` requests are
+    done at the same time, and at most `per_host` of them go to the same host.
+    A new request starts as soon as another one finishes.
+
+    Requests can also be queued with `enqueue`, to be done in the background.
+
+    When a request fails, a size of 0 is cached for HEAD_FAILURE_CACHE_TIME
+    seconds, so that a broken episode file is not requested again for every
+    request for the feed.
+    """
+    def __init__(self, concurrency: int, per_host: int):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = None
+        self.queue = asyncio.Queue()
+        # The episodes that are queued or being probed in the background, with
+        # a future that is done when the request finished
+        self.queued = dict()
+        self.workers = []
+
+    def getSession(self):
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(connector=TCPConnector(
+                limit=self.concurrency, limit_per_host=self.per_host, keepalive_timeout=60
+            ))
+        return self.session
+
+    async def probe(self, id, url, locale):
+        entry = cache.getHeadEntry(id)
+        if entry:
+            return entry
+
+        async with self.semaphore:
+            head_in_flight.inc()
+            start = perf_counter()
+            try:
+                return await self.urlHeadInfo(id, url, locale)
+            except Exception:
+                head_errors.inc()
+                content_type, _ = guess_type(url)
+                cache.insertIntoHeadCache(id, 0, content_type or 'audio/mpeg', HEAD_FAILURE_CACHE_TIME)
+                raise
+            finally:
+                head_in_flight.dec()
+                head_duration.observe(perf_counter() - start)
+
+    async def urlHeadInfo(self, id, url, locale):
+        retries = 3  # Number of retries
+        timeout = ClientTimeout(total=10)  # 10 seconds timeout for each try
+
+        for attempt in range(retries):
+            try:
+                logging.debug(f"HEAD request to {url} (Attempt {attempt + 1})")
+                async with self.getSession().head(url, allow_redirects=True,
+                                        headers=generateHeaders(None, locale),
+                                        timeout=timeout) as response:
+                    content_length = 0
+                    content_type, _ = guess_type(url)
+                    if 'content-length' in response.headers:
+                        content_length = response.headers['content-length']
+                    if content_type is None and 'content-type' in response.headers:
+                        content_type = response.headers['content-type']
+                    else:
+                        content_type = 'audio/mpeg'
+                    cache.insertIntoHeadCache(id, content_length, content_type)
+                    return (content_length, content_type)
+
+            except asyncio.TimeoutError:
+                if attempt < retries - 1:
+                    logging.info(f"Retrying HEAD request to {url} (Attempt {attempt + 2})")
+                    head_retries.inc()
+                    await asyncio.sleep(1)  # Wait for 1 second before retrying
+                else:
+                    logging.error(f"All retries failed for HEAD request to {url}")
+                    raise  # Re-raise the last exception if all retries fail
+
+    # Returns a future that is done when the request finished
+    def enqueue(self, id, url, locale):
+        done = self.queued.get(id)
+        if done is not None:
+            return done
+        done = asyncio.get_running_loop().create_future()
+        self.queued[id] = done
+        self.queue.put_nowait((id, url, locale))
+        if not self.workers:
+            self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.concurrency)]
+        return done
+
+    async def worker(self):
+        while True:
+            id, url, locale = await self.queue.get()
+            try:
+                await self.probe(id, url, locale)
+            except Exception as e:
+                logging.error(f"Background HEAD request for episode {id} failed: {e}")
+            finally:
+                done = self.queued.pop(id, None)
+                if done is not None and not done.done():
+                    done.set_result(None)
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+head_prober = HeadProber(HEAD_CONCURRENCY, HEAD_CONCURRENCY_PER_HOST)
+registry.add(Gauge(
+    "podimo_head_queue_depth", "Number of HEAD requests to episode files that wait to be done in the background",
+    collect=lambda: {(): head_prober.queue.qsize()}))
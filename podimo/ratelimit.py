@@ -0,0 +1,123 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from podimo.config import GRAPHQL_RATE_LIMIT, GRAPHQL_BURST, GRAPHQL_MAX_QUEUE, WORKERS
+from podimo.metrics import registry, Gauge, Histogram
+from podimo.transport import QueueFullError
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from time import monotonic
+import asyncio
+
+# Requests for feeds go before work in the background, like refreshing podcasts
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# The priority of the requests to Podimo that are sent in the current context
+request_priority = ContextVar("request_priority", default=INTERACTIVE)
+
+queue_time = registry.add(Histogram(
+    "podimo_graphql_queue_seconds", "Time that GraphQL requests waited for the rate limiter", ["priority"]))
+
+class RateLimiter:
+    """
+    Keeps the number of requests to Podimo below `rate` per second, with
+    bursts of at most `burst` requests (a token bucket). Requests that have to
+    wait are served by priority, and within a priority, the users (`key`) take
+    turns. At most `max_waiting` requests can wait; beyond that requests fail.
+    A `rate` of 0 disables the limit.
+    """
+    def __init__(self, rate: float, burst: int, max_waiting: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_waiting = max_waiting
+        self.tokens = self.burst
+        self.updated = monotonic()
+        # For every priority, the waiting requests of each user, in the
+        # order in which the users take turns
+        self.queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self.waiting = 0
+        self.dispatcher = None
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, key):
+        if self.rate <= 0:
+            return
+        priority = request_priority.get()
+        start = monotonic()
+        self.refill()
+        if self.waiting == 0 and self.tokens >= 1:
+            self.tokens -= 1
+        else:
+            if self.waiting >= self.max_waiting:
+                # The waiting requests are sent within this many seconds
+                raise QueueFullError((self.waiting + 1) / self.rate)
+            future = asyncio.get_running_loop().create_future()
+            self.queues[priority].setdefault(key, deque()).append(future)
+            self.waiting += 1
+            if self.dispatcher is None or self.dispatcher.done():
+                self.dispatcher = asyncio.ensure_future(self.dispatch())
+            await future
+        queue_time.observe(monotonic() - start, priority=PRIORITY_NAMES[priority])
+
+    # Returns the next waiting request, skipping the ones that were cancelled
+    def next(self):
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            while queue:
+                key, waiters = next(iter(queue.items()))
+                future = waiters.popleft()
+                if waiters:
+                    queue.move_to_end(key)
+                else:
+                    del queue[key]
+                self.waiting -= 1
+                if not future.done():
+                    return future
+        return None
+
+    async def dispatch(self):
+        while self.waiting > 0:
+            self.refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            future = self.next()
+            if future is None:
+                break
+            self.tokens -= 1
+            future.set_result(None)
+
+    def waitingByPriority(self):
+        return {
+            (PRIORITY_NAMES[priority],): sum(len(waiters) for waiters in queue.values())
+            for priority, queue in self.queues.items()
+        }
+
+# Every worker gets an equal share of the limit
+rate_limiter = RateLimiter(GRAPHQL_RATE_LIMIT / WORKERS, GRAPHQL_BURST, GRAPHQL_MAX_QUEUE)
+
+registry.add(Gauge(
+    "podimo_graphql_rate_limit_waiting", "Number of GraphQL requests that wait for the rate limiter",
+    ["priority"], collect=rate_limiter.waitingByPriority))
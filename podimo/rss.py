@@ -0,0 +1,125 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+# Writes RSS feeds piece by piece, so the <item> of every episode can be cached
+# and reused. The output is the same as what feedgen generates for the fields
+# that are used by this tool.
+
+import dateutil.parser
+import logging
+import re
+
+XML_DECLARATION = "<?xml version='1.0' encoding='UTF-8'?>\n"
+RSS_START = ('<rss xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd" '
+             'xmlns:atom="http://www.w3.org/2005/Atom" '
+             'xmlns:content="http://purl.org/rss/1.0/modules/content/" version="2.0">\n')
+RSS_END = "  </channel>\n</rss>\n"
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+# Characters that are not allowed in XML documents
+invalid_xml_chars = re.compile("[^\u0009\u000A\u000D\u0020-\uD7FF\uE000-\uFFFD\U00010000-\U0010FFFF]")
+
+def escapeText(text):
+    text = invalid_xml_chars.sub("", str(text))
+    return (text.replace("&", "&amp;").replace("<", "&lt;")
+                .replace(">", "&gt;").replace("\r", "&#13;"))
+
+def escapeAttribute(text):
+    return (escapeText(text).replace('"', "&quot;").replace("\n", "&#10;")
+                            .replace("\t", "&#9;"))
+
+def element(indent, tag, text):
+    return f"{' ' * indent}<{tag}>{escapeText(text)}</{tag}>\n"
+
+# Format a date according to RFC 2822, independent of the locale
+def formatRFC2822(date):
+    return (f"{DAYS[date.weekday()]}, {date.day:02d} {MONTHS[date.month - 1]} "
+            f"{date.year:04d} {date.strftime('%H:%M:%S %z')}")
+
+def parseDate(date):
+    try:
+        parsed = dateutil.parser.parse(date)
+    except (ValueError, OverflowError):
+        logging.debug(f"Ignoring invalid date '{date}'")
+        return None
+    if parsed.tzinfo is None:
+        logging.debug(f"Ignoring date without timezone '{date}'")
+        return None
+    return parsed
+
+# `lastBuildDate` is left out when it is None. `links` is a list of (rel, href)
+# tuples that are added as atom:link elements, like the links between the
+# pages of a paged feed (RFC 5005).
+def renderChannel(title, link, description, image, language, author, block, lastBuildDate, links=()):
+    channel = [XML_DECLARATION, RSS_START, "  <channel>\n",
+        element(4, "title", title),
+        element(4, "link", link),
+        element(4, "description", description),
+        element(4, "docs", "http://www.rssboard.org/rss-specification"),
+        element(4, "generator", "python-feedgen"),
+    ]
+    if image:
+        channel += ["    <image>\n",
+            element(6, "url", image),
+            element(6, "title", title),
+            element(6, "link", link),
+            "    </image>\n",
+        ]
+    if language:
+        channel.append(element(4, "language", language))
+    if lastBuildDate is not None:
+        channel.append(element(4, "lastBuildDate", formatRFC2822(lastBuildDate)))
+    if author:
+        channel.append(element(4, "itunes:author", author))
+    if block is not None:
+        channel.append(element(4, "itunes:block", "yes" if block else "no"))
+    for rel, href in links:
+        channel.append(f'    <atom:link rel="{escapeAttribute(rel)}" href="{escapeAttribute(href)}"/>\n')
+    return "".join(channel)
+
+def renderItem(guid, title, description, pubDate, image, url, duration, length, type):
+    item = ["    <item>\n"]
+    if title:
+        item.append(element(6, "title", title))
+    if description:
+        item.append(element(6, "description", description))
+    if guid:
+        item.append(f'      <guid isPermaLink="false">{escapeText(guid)}</guid>\n')
+    if url is not None:
+        item.append(f'      <enclosure url="{escapeAttribute(url)}" '
+                    f'length="{escapeAttribute(length)}" type="{escapeAttribute(type)}"/>\n')
+    if pubDate:
+        date = parseDate(pubDate)
+        if date is not None:
+            item.append(element(6, "pubDate", formatRFC2822(date)))
+    if image:
+        if image.endswith(".jpg") or image.endswith(".png"):
+            item.append(f'      <itunes:image href="{escapeAttribute(image)}"/>\n')
+        else:
+            logging.debug(f"Ignoring image '{image}' that is not a png or jpg")
+    if url is not None and duration is not None:
+        duration = str(duration)
+        if len(duration.split(":")) > 3 or duration.lstrip("0123456789:") != "":
+            logging.debug(f"Ignoring invalid duration '{duration}'")
+        elif duration:
+            item.append(element(6, "itunes:duration", duration))
+    item.append("    </item>\n")
+    return "".join(item)
@@ -0,0 +1,101 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from podimo.config import PODCAST_CACHE_TIME, REFRESH_MIN_REQUESTS, REFRESH_AHEAD_TIME
+from podimo.cache import getCacheTimeLeft, podcast_cache
+from podimo.timing import current_timings
+from podimo.ratelimit import request_priority, BACKGROUND
+from collections import deque
+from time import time
+import asyncio
+import logging
+
+# How often the scheduler checks for podcasts that should be refreshed
+REFRESH_INTERVAL = 60
+
+class RefreshScheduler:
+    """
+    Keeps track of how often each podcast is requested, and refreshes the
+    popular ones in the background before their cache entry expires.
+    Expired podcasts that are still served from cache are refreshed through
+    this scheduler as well.
+    """
+    def __init__(self):
+        # Timestamps of the recent requests for each podcast
+        self.requests = dict()
+        # The client of the most recent request for each podcast. It is used
+        # to refresh the podcast on behalf of its listeners.
+        self.clients = dict()
+        self.refreshing = set()
+        self.tasks = set()
+
+    def track(self, podcast_id, client):
+        now = time()
+        hits = self.requests.setdefault(podcast_id, deque())
+        hits.append(now)
+        self.prune(hits, now)
+        self.clients[podcast_id] = client
+
+    def prune(self, hits, now):
+        while hits and hits[0] < now - PODCAST_CACHE_TIME:
+            hits.popleft()
+
+    def refreshSoon(self, podcast_id, client):
+        if podcast_id in self.refreshing:
+            return
+        self.refreshing.add(podcast_id)
+        task = asyncio.ensure_future(self.refresh(podcast_id, client))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def refresh(self, podcast_id, client):
+        # The refresh is not part of the request that started it
+        current_timings.set(None)
+        request_priority.set(BACKGROUND)
+        try:
+            logging.debug(f"Refreshing podcast {podcast_id} in the background")
+            await client.refreshPodcasts(podcast_id)
+        except Exception as e:
+            logging.error(f"Background refresh of podcast {podcast_id} failed: {e}")
+        finally:
+            self.refreshing.discard(podcast_id)
+
+    def refreshPopularPodcasts(self):
+        now = time()
+        for podcast_id in list(self.requests):
+            hits = self.requests[podcast_id]
+            self.prune(hits, now)
+            if not hits:
+                del self.requests[podcast_id]
+                del self.clients[podcast_id]
+                continue
+            if len(hits) < REFRESH_MIN_REQUESTS:
+                continue
+            if getCacheTimeLeft(podcast_id, podcast_cache) <= REFRESH_AHEAD_TIME:
+                self.refreshSoon(podcast_id, self.clients[podcast_id])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL)
+            try:
+                self.refreshPopularPodcasts()
+            except Exception as e:
+                logging.error(f"Error while scheduling podcast refreshes: {e}")
+
+refresh_scheduler = RefreshScheduler()
@@ -0,0 +1,114 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from podimo.config import HTTP_PROXY, ZENROWS_API, SCRAPER_POOL_SIZE, SCRAPER_MAX_AGE
+from contextlib import asynccontextmanager
+from time import time
+import asyncio
+import logging
+import cloudscraper
+if ZENROWS_API is not None:
+    from zenrows import ZenRowsClient
+
+# The proxies that are used by the scrapers
+proxies = dict()
+if HTTP_PROXY:
+    proxies['https'] = HTTP_PROXY
+
+class ScraperPool:
+    """
+    Keeps scrapers alive between requests, so their connections to Podimo and
+    the Cloudflare cookies they received can be reused. There is a separate
+    pool for every proxy configuration, and at most `size` scrapers of a pool
+    are in use at the same time. Scrapers are replaced after they run into an
+    error, or when they are older than `max_age` seconds.
+    """
+    def __init__(self, size: int, max_age: int):
+        self.size = size
+        self.max_age = max_age
+        self.idle = dict()
+        self.semaphores = dict()
+        # The creation time of every scraper, by the id of the scraper
+        self.created = dict()
+        # The ids of the scrapers that ran into an error
+        self.broken = set()
+
+    def key(self, proxies):
+        return tuple(sorted(proxies.items()))
+
+    @asynccontextmanager
+    async def acquire(self, proxies=proxies):
+        key = self.key(proxies)
+        semaphore = self.semaphores.setdefault(key, asyncio.Semaphore(self.size))
+        async with semaphore:
+            scraper = self.take(key, proxies)
+            try:
+                yield scraper
+            except Exception:
+                self.markBroken(scraper)
+                raise
+            finally:
+                self.release(key, scraper)
+
+    def take(self, key, proxies):
+        idle = self.idle.setdefault(key, [])
+        while idle:
+            scraper = idle.pop()
+            if self.isHealthy(scraper):
+                return scraper
+            self.close(scraper)
+        return self.create(proxies)
+
+    def release(self, key, scraper):
+        if self.isHealthy(scraper):
+            self.idle[key].append(scraper)
+        else:
+            self.close(scraper)
+
+    def create(self, proxies):
+        if ZENROWS_API is not None:
+            scraper = ZenRowsClient(ZENROWS_API)
+        else:
+            scraper = cloudscraper.create_scraper()
+            scraper.proxies = dict(proxies)
+        self.created[id(scraper)] = time()
+        return scraper
+
+    def isHealthy(self, scraper):
+        created = self.created.get(id(scraper), 0)
+        return id(scraper) not in self.broken and time() - created < self.max_age
+
+    def markBroken(self, scraper):
+        if id(scraper) in self.created:
+            self.broken.add(id(scraper))
+
+    def close(self, scraper):
+        logging.debug("Closing scraper")
+        self.created.pop(id(scraper), None)
+        self.broken.discard(id(scraper))
+        try:
+            if ZENROWS_API is not None:
+                scraper.requests_session.close()
+                scraper.executor.shutdown(wait=False)
+            else:
+                scraper.close()
+        except Exception as e:
+            logging.debug(f"Error while closing scraper: {e}")
+
+scraper_pool = ScraperPool(SCRAPER_POOL_SIZE, SCRAPER_MAX_AGE)
@@ -0,0 +1,54 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+import asyncio
+import logging
+
+class SingleFlight:
+    """
+    Makes sure that only one call for a given key is in flight at the same time.
+    Concurrent callers with the same key wait for the result of the first call,
+    and receive the same result or exception.
+
+    With `locks` (see `podimo.locks.FillLocks`), calls for the same key in
+    other worker processes are waited for as well. The call should then check
+    whether another worker already did the work while it was waiting.
+    """
+    def __init__(self, name: str, locks=None):
+        self.name = name
+        self.locks = locks
+        self.flights = dict()
+
+    async def do(self, key, func):
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.call(key, func))
+            self.flights[key] = task
+            task.add_done_callback(lambda _: self.flights.pop(key, None))
+        else:
+            logging.debug(f"Waiting for in-flight {self.name} of {key}")
+        # Shield the shared task, so that a caller that goes away (e.g. a client
+        # that disconnects) does not cancel the call for all other callers.
+        return await asyncio.shield(task)
+
+    async def call(self, key, func):
+        if self.locks is None:
+            return await func()
+        async with self.locks.hold(f"{self.name}~{key}"):
+            return await func()
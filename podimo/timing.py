@@ -0,0 +1,78 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+import json
+import logging
+
+class Timings:
+    """
+    Keeps track of the time that is spent in each phase of handling a request,
+    for the Server-Timing header and the timing log. A phase can occur more
+    than once, for example when multiple pages of episodes are fetched.
+    """
+    def __init__(self, **fields):
+        # Fields that are added to the log record, like the id of the podcast
+        self.fields = fields
+        self.start = perf_counter()
+        # Tuples of the name, description and duration (in seconds) of each phase
+        self.phases = []
+
+    def add(self, name, duration, description=None):
+        self.phases.append((name, description, duration))
+
+    def total(self):
+        return perf_counter() - self.start
+
+    # The value of the Server-Timing header, see
+    # https://www.w3.org/TR/server-timing/
+    def header(self):
+        metrics = []
+        for name, description, duration in self.phases + [("total", None, self.total())]:
+            metric = f"{name};dur={duration * 1000:.1f}"
+            if description is not None:
+                metric += f';desc="{description}"'
+            metrics.append(metric)
+        return ", ".join(metrics)
+
+    def log(self, **fields):
+        phases = [
+            {"name": name, "desc": description, "ms": round(duration * 1000, 1)}
+            for name, description, duration in self.phases
+        ]
+        record = {**self.fields, **fields, "total_ms": round(self.total() * 1000, 1), "phases": phases}
+        logging.info(f"Timing: {json.dumps(record)}")
+
+# The timings of the request that is being handled. It is None outside of
+# requests, and in background tasks.
+current_timings = ContextVar("current_timings", default=None)
+
+@contextmanager
+def measure(name, description=None):
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, perf_counter() - start, description)
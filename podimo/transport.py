@@ -0,0 +1,140 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+from podimo.config import ZENROWS_API, GRAPHQL_TRANSPORT, GRAPHQL_CONCURRENCY, GRAPHQL_MAX_QUEUE
+from podimo.scrapers import proxies
+from aiohttp import ClientSession, ClientTimeout, DummyCookieJar, TCPConnector
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from yarl import URL
+import asyncio
+import logging
+
+# Raised when too many requests are waiting to be sent to Podimo
+class QueueFullError(RuntimeError):
+    def __init__(self, retry_after: float = 1):
+        super().__init__("Too many requests to Podimo are waiting")
+        self.retry_after = retry_after
+
+class Transport:
+    """
+    Sends requests to Podimo. At most `concurrency` requests are sent at the
+    same time, and at most `max_queue` requests are allowed to wait for their
+    turn. Requests beyond that fail right away instead of piling up.
+    """
+    # Whether multiple requests can be sent with the same scraper at once
+    shareable = False
+
+    def __init__(self, concurrency: int, max_queue: int):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.pending = 0
+
+    # Returns the status code and the decoded JSON body of the response
+    async def post(self, url, headers, cookie_jar, json, scraper):
+        if self.pending >= self.concurrency + self.max_queue:
+            raise QueueFullError()
+        self.pending += 1
+        try:
+            return await self.send(url, headers, cookie_jar, json, scraper)
+        finally:
+            self.pending -= 1
+
+    def queueDepth(self):
+        return max(0, self.pending - self.concurrency)
+
+    def inFlight(self):
+        return min(self.pending, self.concurrency)
+
+    async def close(self):
+        pass
+
+class ScraperTransport(Transport):
+    """
+    Sends requests with the blocking scrapers from the scraper pool, in a
+    dedicated thread pool that is not shared with the rest of the application.
+    """
+    def __init__(self, concurrency: int, max_queue: int):
+        super().__init__(concurrency, max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="graphql")
+
+    async def send(self, url, headers, cookie_jar, json, scraper):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(self.executor, partial(scraper.post, url,
+                                    headers=headers,
+                                    cookies=cookie_jar,
+                                    json=json,
+                                    timeout=(6.05, 30)
+                                ))
+        if response is None:
+            return None, None
+        if response.status_code != 200:
+            return response.status_code, None
+        return response.status_code, response.json()
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+
+class AiohttpTransport(Transport):
+    """
+    Sends requests with aiohttp, over a shared pool of keep-alive connections.
+    This does not get past Cloudflare's bot detection, so it is only useful
+    when Podimo can be reached directly, or through ScraperAPI.
+    """
+    # The scraper is not used for the requests
+    shareable = True
+
+    def __init__(self, concurrency: int, max_queue: int):
+        super().__init__(concurrency, max_queue)
+        self.session = None
+
+    def getSession(self):
+        if self.session is None or self.session.closed:
+            # Every user has their own cookie jar, so the session doesn't keep any cookies
+            self.session = ClientSession(
+                connector=TCPConnector(limit=self.concurrency, keepalive_timeout=60),
+                cookie_jar=DummyCookieJar(),
+                timeout=ClientTimeout(sock_connect=6.05, sock_read=30),
+            )
+        return self.session
+
+    async def send(self, url, headers, cookie_jar, json, scraper):
+        cookies = None
+        if cookie_jar is not None:
+            cookies = cookie_jar.filter_cookies(URL(url))
+        async with self.getSession().post(url, headers=headers, cookies=cookies, json=json,
+                                          proxy=proxies.get('https')) as response:
+            if cookie_jar is not None:
+                cookie_jar.update_cookies(response.cookies, response.url)
+            if response.status != 200:
+                return response.status, None
+            return response.status, await response.json(content_type=None)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+def createTransport():
+    if GRAPHQL_TRANSPORT == "aiohttp":
+        if ZENROWS_API is None:
+            return AiohttpTransport(GRAPHQL_CONCURRENCY, GRAPHQL_MAX_QUEUE)
+        logging.warning("GRAPHQL_TRANSPORT=aiohttp does not work with ZenRows, using cloudscraper instead")
+    return ScraperTransport(GRAPHQL_CONCURRENCY, GRAPHQL_MAX_QUEUE)
+
+transport = createTransport()
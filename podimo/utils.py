@@ -20,8 +20,6 @@
 from email.utils import parseaddr
 from random import choice, randint
 from hashlib import sha256
-import asyncio
-from functools import wraps, partial
 
 def randomHexId(length: int):
     string = []
@@ -59,12 +57,3 @@ def generateHeaders(authorization, locale):
     if authorization:
         headers["authorization"] = authorization
     return headers
-
-def async_wrap(func):
-    @wraps(func)
-    async def run(*args, loop=None, executor=None, **kwargs):
-        if loop is None:
-            loop = asyncio.get_event_loop()
-        pfunc = partial(func, *args, **kwargs)
-        return await loop.run_in_executor(executor, pfunc)
-    return run
@@ -0,0 +1,75 @@
+# Copyright 2022 Thijs Raymakers
+#
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# https://joinup.ec.europa.eu/software/page/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+# Fills the cache of the tool with podcasts and the sizes of their episodes,
+# for example on a new server before it starts serving feeds. Podcasts are
+# read from OPML files (like an export of a podcast app), from files with
+# podcast ids or feed URLs, or are given as arguments. Use "-" to read from
+# standard input.
+#
+#   python prewarm.py --region nl --locale nl-NL subscriptions.opml
+#
+# The Podimo account is read from PODIMO_EMAIL and PODIMO_PASSWORD, or asked for.
+# A running instance can be pre-warmed through its /prewarm endpoint instead.
+
+from podimo.config import PODIMO_EMAIL, PODIMO_PASSWORD
+from getpass import getpass
+from os.path import exists
+import argparse
+import asyncio
+import json
+import sys
+import main
+
+def read_podcast_ids(sources):
+    texts = []
+    for source in sources:
+        if source == "-":
+            texts.append(sys.stdin.read())
+        elif exists(source):
+            with open(source, "r") as file:
+                texts.append(file.read())
+        else:
+            texts.append(source)
+    return main.extract_podcast_ids("\n".join(texts))
+
+async def run(args):
+    podcast_ids = read_podcast_ids(args.sources)
+    if not podcast_ids:
+        sys.exit("No podcast ids found")
+
+    email = args.email or PODIMO_EMAIL or input("Podimo email: ")
+    # The password in the configuration only belongs to PODIMO_EMAIL
+    password = (PODIMO_PASSWORD if email == PODIMO_EMAIL else None) or getpass("Podimo password: ")
+    try:
+        client = await main.check_auth(email, password, args.region, args.locale)
+        if not client:
+            sys.exit("Could not login to Podimo")
+        summary = await main.prewarm(client, podcast_ids, args.locale)
+        print(json.dumps(summary, indent=2))
+    finally:
+        await main.close_connections()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill the cache with podcasts")
+    parser.add_argument("sources", nargs="+", help="OPML files, files with podcast ids, podcast ids, or - for standard input")
+    parser.add_argument("--email", help="email address of the Podimo account")
+    parser.add_argument("--region", default="nl")
+    parser.add_argument("--locale", default="nl-NL")
+    asyncio.run(run(parser.parse_args()))